@@ -2,20 +2,30 @@ import sys
 sys.path.append(r"C:\Program Files (x86)\CST STUDIO SUITE 2023\AMD64\python_cst_libraries")
 sys.path.append(r"C:\Program Files (x86)\CST STUDIO SUITE 2024\AMD64\python_cst_libraries")
 sys.path.append(r"C:\Program Files (x86)\CST STUDIO SUITE 2025\AMD64\python_cst_libraries")
-import cst
-import cst.results as cstr
-import cst.interface as csti
+try:
+    import cst
+    import cst.results as cstr
+    import cst.interface as csti
+except ImportError: # only CSTInterface needs CST, replay backends run without it
+    print("CST python libraries not found, only non-CST backends available")
 import os
+import shutil
 import time
 import csv
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.ndimage as scimage
-from scipy.fft import fft, fftfreq
+from scipy.fft import fft, fftfreq, rfft, irfft
 from PIL import Image, ImageDraw, ImageFont
 import matplotlib.colors as colors
 from math import ceil, sqrt
 import difflib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, cached_property
+from dataclasses import dataclass, replace, asdict
 
 
 # Design parameter
@@ -34,10 +44,151 @@ HS = 1.6
 FEEDX = 5
 FEEDY = 0
 
+# Default plane wave incidence (propagation normal, E vector): normal incidence, x polarized
+INCIDENCE = ((0, 0, -1), (1, 0, 0))
+
+# Solver fidelity levels, cheapest first (mesh steps per wavelength, steady state accuracy in dB, max pulse widths)
+FIDELITY = {
+    'low': {'steps_per_wave': 10, 'accuracy': -25, 'pulse_widths': 10},
+    'medium': {'steps_per_wave': 15, 'accuracy': -30, 'pulse_widths': 15},
+    'high': {'steps_per_wave': 20, 'accuracy': -40, 'pulse_widths': 20},
+    }
+
+
+@dataclass(frozen=True)
+class DesignConfig:
+    '''
+    Immutable design configuration passed to Controller, Optimizer, Plotter and the shape
+    generators (module constants above are the defaults). Derived pixel geometry is computed
+    once per configuration and cached. Variants: dataclasses.replace(DEFAULT_CONFIG, D=2)
+    '''
+    L: float = L # design region, mm
+    W: float = W
+    D: float = D # pixel size
+    TSTEP: float = TSTEP # default time step and duration, ns (specification overrides them)
+    TEND: float = TEND
+    LG: float = LG # ground and substrate size
+    WG: float = WG
+    HC: float = HC # copper and substrate thickness
+    HS: float = HS
+    FEEDX: float = FEEDX # feed position
+    FEEDY: float = FEEDY
+
+    @cached_property
+    def nx(self): return int(self.L//self.D)
+
+    @cached_property
+    def ny(self): return int(self.W//self.D)
+
+    @cached_property
+    def pixels(self): return self.nx*self.ny
+
+    @cached_property
+    def index_map(self):
+        # index_map[yi, xi] = pixel index, same ordering as set_domain (x fastest)
+        return np.arange(self.pixels).reshape(self.ny, self.nx)
+
+    @cached_property
+    def pixel_boxes(self):
+        # [xmin, xmax, ymin, ymax] of every pixel brick
+        index = np.arange(self.pixels)
+        xmin = (index % self.nx)*self.D - self.L/2
+        ymin = (index // self.nx)*self.D - self.W/2
+        return np.stack([xmin, xmin+self.D, ymin, ymin+self.D], axis=1)
+
+    @cached_property
+    def pixel_centers(self):
+        boxes = self.pixel_boxes
+        return np.stack([(boxes[:, 0]+boxes[:, 1])/2, (boxes[:, 2]+boxes[:, 3])/2], axis=1)
+
+    @cached_property
+    def symmetry_map(self):
+        # mirror pixel across the xz plane (xz_symmetric_boundary), symmetry_map[symmetry_map] = identity
+        return np.flipud(self.index_map).ravel()
+
+    @cached_property
+    def modeled_half(self):
+        # pixels on the y>=0 side that a xz_symmetric_boundary solve models (pixel or its mirror has the lower index)
+        return np.arange(self.pixels) >= self.symmetry_map
+
+    def solved_half(self, symmetric, size=None):
+        # pixel mask a solve sees: modeled_half for symmetric solves, None (every pixel) otherwise or for cell distributions
+        if not symmetric or (size is not None and size != self.pixels): return None
+        return self.modeled_half
+
+DEFAULT_CONFIG = DesignConfig()
+
+
+# Bit count of every byte value, for Topology.distance
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], np.uint8)
+
+class Topology:
+    '''
+    Binarized design (1 metal, 0 empty) packed 8 pixels per byte. Hashable and comparable, so
+    it keys dicts and caches directly; key is a short hex digest for file names and logs.
+    half (DesignConfig.solved_half) packs only the pixels a symmetric solve models, so designs
+    whose y>=0 halves match share one Topology, the canonical key of that solve.
+    '''
+    __slots__ = ('bits', 'pixels', '_hash')
+
+    def __init__(self, bits, pixels):
+        self.bits = bytes(bits)
+        self.pixels = pixels
+        self._hash = hash(self.bits)
+
+    @classmethod
+    def from_binary(cls, binary, half=None):
+        binary = np.asarray(binary).ravel() != 0
+        if half is not None: binary = binary[half]
+        return cls(np.packbits(binary).tobytes(), binary.size)
+
+    @classmethod
+    def from_cond(cls, cond, metal=9000, half=None):
+        # same metal cut as update_distribution
+        return cls.from_binary(np.asarray(cond) >= metal, half)
+
+    @staticmethod
+    def is_binary(values):
+        # only 0 and one other value (primal 0/1 or conductivity 0/metal)
+        values = np.asarray(values)
+        return values.min() == 0 and bool(np.all((values == 0) | (values == values.max())))
+
+    def array(self):
+        return np.unpackbits(np.frombuffer(self.bits, np.uint8), count=self.pixels)
+
+    def __eq__(self, other):
+        return isinstance(other, Topology) and self.bits == other.bits and self.pixels == other.pixels
+
+    def __hash__(self): return self._hash
+    def __len__(self): return self.pixels
+    def __repr__(self): return f"Topology({self.key}, {self.count()}/{self.pixels} metal)"
+
+    @property
+    def key(self):
+        return hashlib.blake2b(self.bits, digest_size=8).hexdigest()
+
+    def count(self):
+        return int(POPCOUNT[np.frombuffer(self.bits, np.uint8)].sum())
+
+    def xor(self, other):
+        return np.bitwise_xor(np.frombuffer(self.bits, np.uint8), np.frombuffer(other.bits, np.uint8))
+
+    def distance(self, other):
+        # number of pixels that differ
+        return int(POPCOUNT[self.xor(other)].sum())
+
+    def diff(self, other):
+        # indices of pixels that differ
+        return np.flatnonzero(np.unpackbits(self.xor(other), count=self.pixels))
+
 
 class CSTInterface:
     def __init__(self, fname):
-        self.full_path = os.getcwd() + f"\{fname}"
+        if os.path.isabs(fname): self.full_path = fname
+        else: self.full_path = os.getcwd() + f"\{fname}"
+        self.vba_batch = None # open VBABatch collecting commands, see batch()
+        self.batch_latency = {} # {batch name: [seconds,...]}
+        self.persistent_signals = None # {signal name: file} once persistent excitation is defined
         self.opencst()
 
     def opencst(self):
@@ -90,16 +241,36 @@ class CSTInterface:
         self.prj.modeler.full_history_rebuild() 
         #update history, might discard changes if not added to history list
         self.prj.save()
+        self.persistent_signals = None # port, plane wave and signals don't survive a save
 
     def close(self):
         self.de.close()
 
+    def close_project(self): # keep the design environment for other projects
+        self.prj.close()
+
     def excute_vba(self,  command):
+        if self.vba_batch is not None: # collected, runs as one macro when the batch closes
+            self.vba_batch.add(command)
+            return None
         command = "\n".join(command)
         vba = self.prj.schematic
         res = vba.execute_vba_code(command)
         return res
 
+    def batch(self, name):
+        '''
+        Collect every excute_vba call inside the with-block into a single macro (one round trip):
+            with controller.batch("rx setup"):
+                controller.set_port(...)
+                controller.set_plane_wave()
+        '''
+        return VBABatch(self, name)
+
+    def batch_report(self):
+        for name, latency in self.batch_latency.items():
+            print(f"VBA batch '{name}': {len(latency)} calls, mean {np.mean(latency):.3f} s, total {np.sum(latency):.3f} s")
+
     def create_para(self,  para_name, para_value): #create or change are the same
         command = ['Sub Main', 'StoreDoubleParameter("%s", "%.4f")' % (para_name, para_value),
                 'RebuildOnParametricChange(False, True)', 'End Sub']
@@ -156,20 +327,36 @@ class CSTInterface:
     def start_simulate(self, plane_wave_excitation=False):
         print("Solving...")
         try: # problems occur with extreme conditions
-            if plane_wave_excitation:
-                command = ['Sub Main', 'With Solver', 
-                '.StimulationPort "Plane wave"', 'End With', 'End Sub']
-                self.excute_vba(command)
-                print("Plane wave excitation = True")
+            if plane_wave_excitation: self.set_stimulation_plane_wave()
             # one actually should not do try-except otherwise severe bug may NOT be detected
             model = self.prj.modeler
             model.run_solver()
         except Exception as e: pass
         print("Solved")
     
-    def set_plane_wave(self):  # doesn't update history, disappear after save but remain after simulation
+    def set_fidelity(self, name, settings):
+        # mesh density, time solver accuracy and maximum duration, in history so saves keep them
+        command = ['With MeshSettings', '.SetMeshType "Hex"', 
+                   f'.Set "StepsPerWaveNear", "{settings["steps_per_wave"]}"', 
+                   f'.Set "StepsPerWaveFar", "{settings["steps_per_wave"]}"', 'End With', 
+                   'With Solver', f'.SteadyStateLimit "{settings["accuracy"]}"', 
+                   f'.NumberOfPulseWidths "{settings["pulse_widths"]}"', 'End With']
+        command = "\n".join(command)
+        self.prj.modeler.add_to_history(f"fidelity {name}",command)
+        print(f"Fidelity {name} set")
+
+    def set_stimulation_plane_wave(self):
+        command = ['Sub Main', 'With Solver', 
+        '.StimulationPort "Plane wave"', 'End With', 'End Sub']
+        res = self.excute_vba(command)
+        print("Plane wave excitation = True")
+        return res
+
+    def set_plane_wave(self, incidence=INCIDENCE):  # doesn't update history, disappear after save but remain after simulation
+        normal, e_vector = incidence
         command = ['Sub Main', 'With PlaneWave', '.Reset ', 
-                   '.Normal "0", "0", "-1" ', '.EVector "1", "0", "0" ', 
+                   f'.Normal "{normal[0]}", "{normal[1]}", "{normal[2]}" ', 
+                   f'.EVector "{e_vector[0]}", "{e_vector[1]}", "{e_vector[2]}" ', 
                    '.Polarization "Linear" ', '.ReferenceFrequency "2" ', 
                    '.PhaseDifference "-90.0" ', '.CircularDirection "Left" ', 
                    '.AxialRatio "0.0" ', '.SetUserDecouplingPlane "False" ', 
@@ -177,17 +364,29 @@ class CSTInterface:
         res = self.excute_vba(command)
         return res
     
-    def set_excitation(self, filePath): # doesn't update history, disappear after save but remain after simulation. 
+    def set_excitation(self, filePath, name="signal1", id=1): # doesn't update history, disappear after save but remain after simulation. 
         # set .UseCopyOnly to false otherwise CST read cache
         command = ['Sub Main', 'With TimeSignal ', '.Reset ', 
-                   '.Name "signal1" ', '.SignalType "Import" ', 
+                   f'.Name "{name}" ', '.SignalType "Import" ', 
                    '.ProblemType "High Frequency" ', 
                    f'.FileName "{filePath}" ', 
-                   '.Id "1"', '.UseCopyOnly "false" ', '.Periodic "False" ', 
-                   '.Create ', '.ExcitationSignalAsReference "signal1", "High Frequency"',
+                   f'.Id "{id}"', '.UseCopyOnly "false" ', '.Periodic "False" ', 
+                   '.Create ', f'.ExcitationSignalAsReference "{name}", "High Frequency"',
                    'End With', 'End Sub']
         res = self.excute_vba(command)
         return res
+
+    def set_reference_signal(self, name):
+        command = ['Sub Main', 'With TimeSignal', 
+                   f'.ExcitationSignalAsReference "{name}", "High Frequency"', 'End With', 'End Sub']
+        res = self.excute_vba(command)
+        return res
+
+    def set_stimulation_port(self, port="1"):
+        command = ['Sub Main', 'With Solver', 
+        f'.StimulationPort "{port}"', 'End With', 'End Sub']
+        res = self.excute_vba(command)
+        return res
     
     def delete_plane_wave(self):
         command = ['Sub Main', 'PlaneWave.Delete', 'End Sub']
@@ -219,15 +418,18 @@ class CSTInterface:
         res = self.excute_vba(command)
         return res
     
-    def export_E_field(self, outputPath, resultPath, time_end, time_step, d_step):
+    def export_E_field(self, outputPath, resultPath, time_end, time_step, d_step, subvolume=None):
+        # subvolume: (xmin, xmax, ymin, ymax, zmin, zmax) to export, None for the whole monitor
         total_samples = int(time_end/time_step)
         command = ['Sub Main',
         'SelectTreeItem  ("%s")' % resultPath, 
         'With ASCIIExport', '.Reset',
         f'.FileName ("{outputPath}")',
         f'.SetSampleRange(0, {total_samples})',
-        '.Mode ("FixedWidth")', f'.Step ({d_step})',
-        '.Execute', 'End With', 'End Sub']
+        '.Mode ("FixedWidth")', f'.Step ({d_step})']
+        if subvolume is not None:
+            command += ['.UseSubvolume (True)', '.SetSubvolume (%s)' % ", ".join(str(value) for value in subvolume)]
+        command += ['.Execute', 'End With', 'End Sub']
         res = self.excute_vba(command)
         return res
     
@@ -257,26 +459,84 @@ class CSTInterface:
                    '.OpenAddSpaceFactor "0.5"', 'End With']
         command = "\n".join(command)
         self.prj.modeler.add_to_history("symmetric_boundary",command)
+        self.symmetric = True
         self.save()
         print("Symmetric boundary set")
 
+class VBABatch:
+    def __init__(self, interface, name):
+        self.interface = interface
+        self.name = name
+        self.body = []
+
+    def add(self, command): # drop the Sub Main/End Sub wrapper of single commands
+        self.body += [line for line in command if line not in ('Sub Main', 'End Sub')]
+
+    def __enter__(self):
+        self.interface.vba_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.interface.vba_batch = None
+        if exc_type is None: self.run()
+
+    def run(self):
+        if not self.body: return None
+        start = time.time()
+        res = self.interface.prj.schematic.execute_vba_code(vba_macro(tuple(self.body)))
+        latency = time.time() - start
+        self.interface.batch_latency.setdefault(self.name, []).append(latency)
+        print(f"VBA batch '{self.name}': {len(self.body)} lines in {latency:.3f} s")
+        return res
+
+@lru_cache(maxsize=32)
+def vba_macro(body):
+    # Setup/teardown text is the same every iteration, join it once
+    return "\n".join(('Sub Main',) + body + ('End Sub',))
+
 class Controller(CSTInterface):
-    def __init__(self, fname):
+    '''
+    Receiver/transmitter on a CST project. Options, set before specification/set_monitor:
+        topop.persistent_excitation = True # define port, plane wave and signals once instead of every iteration (needs an excitation file)
+        topop.monitor_mode = "plane" # record the patch layer only, one grid ordered sample per pixel
+    Or copy a prepared base project (then set_environment=False, set_monitor=False, symmetric=False):
+        topop = TemplateCache().create("CST_Antennas/topop.cst", time_step, time_end)
+    Stand-ins without CST: replay.ReplayController, solver_service.RemoteController,
+    jobqueue.QueueController, fdtd.FDTDController.
+    '''
+    def __init__(self, fname, config=None):
         super().__init__(fname)
-        self.Lg = LG
-        self.Wg = WG
-        self.hc = HC
-        self.hs = HS
-        self.feedx = FEEDX
-        self.feedy = FEEDY
-        self.Ld = L
-        self.Wd = W
-        self.d = D
-        self.time_step = TSTEP
-        self.time_end = TEND
+        self.config = DEFAULT_CONFIG if config is None else config
+        self.Lg = self.config.LG
+        self.Wg = self.config.WG
+        self.hc = self.config.HC
+        self.hs = self.config.HS
+        self.feedx = self.config.FEEDX
+        self.feedy = self.config.FEEDY
+        self.Ld = self.config.L
+        self.Wd = self.config.W
+        self.d = self.config.D
+        self.time_step = self.config.TSTEP
+        self.time_end = self.config.TEND
+        # "volume": E field monitor around the whole antenna (legacy), "plane": patch layer only,
+        # exported at the pixel centers and converted to a grid ordered .npy (grid_E_file)
+        self.monitor_mode = "volume"
         point1 = (self.feedx+self.hs/2-0.1, self.feedy, -5-self.hc-self.hs)
         point2 = (self.feedx+self.hs, self.feedy, -5-self.hc-self.hs)
         self.port = (point1, point2)
+        self.last_signals = {} # port signals read by the last excitation, {name: [(time, value),...]}
+        self.applied = None # (Topology, metal conductivity) last written by update_distribution
+        self.symmetric = False # xz symmetric boundary in the project, only the y>=0 half is solved
+        self.record_signals = True # False keeps the port signals of this controller out of the signal store (screening)
+        self.export_fields = True # False: plane_wave_excitation skips the E field export and returns E_Path None (screening)
+        # Plane wave (normal, E vector) of the next plane_wave_excitation
+        self.incidence = INCIDENCE
+        self.defined_incidence = None # incidence of the persistent plane wave
+        # Suffix of txtf files and recorded signal names, keeps concurrent controllers apart
+        self.tag = ""
+        # Keep port, plane wave and signals (signal1 Rx, signal2 Tx) defined across iterations,
+        # each iteration then only selects reference signal and stimulation (files are re-read by CST)
+        self.persistent_excitation = False
 
 
     # initialize ground, substrate, feed, and port
@@ -336,6 +596,7 @@ class Controller(CSTInterface):
     
     def set_monitor(self):
         print("Setting monitor...")
+        if self.monitor_mode == "plane": return self.set_plane_monitor()
         margin = (self.Ld - self.d)/2
         # Set monitor to read E field on domain
         EonPatch = ['With Monitor ', '.Reset ', '.Name "E_field_on_patch" ', 
@@ -363,55 +624,136 @@ class Controller(CSTInterface):
         self.save()
         print("Monitor set")
 
+    def pixel_plane(self):
+        # pixel centers of the design region on the mid plane of the patch layer, as a subvolume
+        c = self.config
+        x0, y0 = c.pixel_centers[0]
+        x1, y1 = c.pixel_centers[-1]
+        z = self.hc/2
+        return (x0, x1, y0, y1, z, z)
+
+    def set_plane_monitor(self):
+        # Same monitor name as the volume one, only the patch layer (pixel center plane) is recorded
+        xmin, xmax, ymin, ymax, z, _ = self.pixel_plane()
+        EonPatch = ['With Monitor ', '.Reset ', '.Name "E_field_on_patch" ', 
+                   '.Dimension "Plane" ', '.Domain "Time" ', '.FieldType "Efield" ', 
+                   '.Tstart "0" ', f'.Tstep "{self.time_step}" ', f'.Tend "{self.time_end}" ', '.UseTend "True" ', 
+                   '.PlaneNormal "z" ', f'.PlanePosition "{z}" ', 
+                   '.UseSubvolume "True" ', '.Coordinates "Free" ', 
+                   f'.SetSubvolume "{xmin}", "{xmax}", "{ymin}", "{ymax}", "{z}", "{z}" ', 
+                   '.SetSubvolumeOffset "0.0", "0.0", "0.0", "0.0", "0.0", "0.0" ', 
+                   '.SetSubvolumeInflateWithOffset "False" ', '.Create ', 'End With']
+        command = "\n".join(EonPatch)
+        self.prj.modeler.add_to_history("set monitor",command)
+        self.save()
+        print(f"Monitor set on patch plane z={z}, {self.config.pixels} pixel centers")
+
+    def export_patch_field(self, E_Path, resultPath):
+        # Export the E field monitor, plane mode returns the grid ordered .npy instead of the text file
+        outputPath = os.getcwd() + "\\" + E_Path
+        if self.monitor_mode != "plane":
+            self.export_E_field(outputPath, resultPath, self.time_end, self.time_step, self.d)
+            return E_Path
+        self.export_E_field(outputPath, resultPath, self.time_end, self.time_step, self.d, self.pixel_plane())
+        return grid_E_file(E_Path, self.config)
+
     def set_domain(self): 
         print("Setting domain...")
         # Initialize domain with uniform conductivity
-        nx, ny = (int(self.Ld//self.d), int(self.Wd//self.d))
-        cond = np.zeros(nx*ny)
-        print(f"{nx*ny} pixels in total...")
+        cond = np.zeros(self.config.pixels)
+        print(f"{self.config.pixels} pixels in total...")
         # Define materials first
         self.update_distribution(cond)
         command = []
         # Define shape and index based on materials
-        for index, sigma in enumerate(cond): 
-            midpoint = (self.Ld/2, self.Wd/2)
-            xi = index%nx
-            yi = index//nx
-            xmin = xi*self.d-midpoint[0]
-            xmax = xmin+self.d
-            ymin = yi*self.d-midpoint[1]
-            ymax = ymin+self.d
+        for index, (xmin, xmax, ymin, ymax) in enumerate(self.config.pixel_boxes): 
             command += self.create_shape(index, xmin, xmax, ymin, ymax, self.hc)
         command = "\n".join(command)
         self.prj.modeler.add_to_history("domain",command)
         self.save()
         print("Domain set")
 
-    def update_distribution(self, cond):
+    def update_distribution(self, cond, pixels=None):
+        # pixels: indices to rewrite (active set), None rewrites every pixel
         print("Conductivity distribution updating...")
+        if pixels is None: pixels = range(len(cond))
+        # Binarized designs: only pixels whose metal/empty state changed since the last update
+        # (symmetric projects: only the solved half is compared, the mirrored half is not modeled)
+        if Topology.is_binary(cond):
+            half = self.config.solved_half(self.symmetric, len(cond))
+            topology = Topology.from_cond(cond, half=half)
+            if self.applied is not None and self.applied[1] == np.max(cond) and len(self.applied[0]) == len(topology):
+                changed = np.zeros(len(cond), bool)
+                diff = self.applied[0].diff(topology)
+                changed[diff if half is None else np.flatnonzero(half)[diff]] = True
+                pixels = [index for index in pixels if changed[index]]
+            self.applied = (topology, np.max(cond))
+        else: self.applied = None
         command_material = []
-        for index, sigma in enumerate(cond):
+        for index in pixels:
+            sigma = cond[index]
             if sigma < 9000: command_material += self.create_cond_material(index, sigma, "Normal")
             else: command_material += self.create_cond_material(index, sigma)
+        if not command_material:
+            print("No pixel changed, distribution kept")
+            return
         command_material = "\n".join(command_material)
         self.prj.modeler.add_to_history("material update",command_material)
         print("Conductivity distribution updated")
 
+    def set_cells(self, boxes, cond):
+        # Replace the design bricks by variable size cells [xmin, xmax, ymin, ymax] (quadtree),
+        # cell k is solid{k} with material{k}, so update_distribution takes one value per cell
+        print(f"Setting {len(boxes)} cells...")
+        self.applied = None
+        self.update_distribution(cond)
+        command = ['Component.Delete "component2"', 'Component.New "component2"']
+        for index, (xmin, xmax, ymin, ymax) in enumerate(boxes): 
+            command += self.create_shape(index, xmin, xmax, ymin, ymax, self.hc)
+        command = "\n".join(command)
+        self.prj.modeler.add_to_history("cells",command)
+        print("Cells set")
+
+    def persistent_setup(self, name, signal_id, filePath):
+        # Define port, plane wave and the named signal (TimeSignal id signal_id) once, later calls only swap to it
+        if self.persistent_signals is None:
+            print("Defining persistent port and plane wave")
+            self.set_port(self.port[0], self.port[1])
+            self.persistent_signals = {}
+            self.defined_incidence = None
+        if self.defined_incidence != [list(v) for v in self.incidence]: # first use or new incidence
+            self.set_plane_wave(self.incidence)
+            self.defined_incidence = [list(v) for v in self.incidence]
+        if self.persistent_signals.get(name) != filePath:
+            if name in self.persistent_signals: self.delete_signal(name)
+            self.set_excitation(filePath, name, id=signal_id)
+            self.persistent_signals[name] = filePath
+        self.set_reference_signal(name)
+
+    def delete_signal(self, name):
+        command = ['Sub Main', 'With TimeSignal', 
+     f'.Delete "{name}", "High Frequency" ', 'End With', 'End Sub']
+        res = self.excute_vba(command)
+        return res
+
     def feed_excitation(self, feedPath):
         print("Start feed exciation")
         # Import feed file
         print("fe: importing feed file")
         feedPath = os.getcwd() + "\\" + feedPath # getcwd so CST don't load cache
-        self.set_excitation(feedPath)
+        with self.batch("fe setup"):
+            if self.persistent_excitation:
+                self.persistent_setup("signal2", 2, feedPath)
+                self.set_stimulation_port("1")
+            else:
+                self.set_excitation(feedPath)
+                self.set_port(self.port[0], self.port[1])
         # Start simulation with feed
         print("fe: simulating")
-        self.set_port(self.port[0], self.port[1])
         self.start_simulate()
         # Export E field on patch to txt
-        E_Path = "txtf\E_excited.txt"
-        outputPath = os.getcwd() + "\\" + E_Path
-        self.export_E_field(outputPath, "2D/3D Results\\E-Field\\E_field_on_patch [1]", self.time_end, self.time_step, self.d)
-        print(f"fe: electric field exported as {outputPath}")
+        E_Path = self.export_patch_field(f"txtf\\E_excited{self.tag}.txt", "2D/3D Results\\E-Field\\E_field_on_patch [1]")
+        print(f"fe: electric field exported as {E_Path}")
         # # Record s11 to s11.csv
         # s11 = self.read('1D Results\\S-Parameters\\S1,1')
         # with open('results\\s11.csv', 'a', newline='') as csvfile:
@@ -421,44 +763,45 @@ class Controller(CSTInterface):
         #         line[1] = 20*np.log10(line[1]) # convert to dB
         #         writer.writerow(line[:-1])
         #     writer.writerow([]) # space line for seperation from next call
-        # Record Tx_input_signal to Tx_input_signal.csv
+        # Record Tx_input_signal and Tx_reflected_signal
         Tx_input_signal = self.read('1D Results\\Port signals\\i1')
-        with open('results\\Tx_input_signal.csv', 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            for line in Tx_input_signal: # [(time, signal_value),...]
-                writer.writerow(line)
-            writer.writerow([]) # space line for seperation from next call
-        # Record Tx_reflected_signal to Tx_reflected_signal.csv
         Tx_reflected_signal = self.read('1D Results\\Port signals\\o1,1')
-        with open('results\\Tx_reflected_signal.csv', 'a', newline='') as csvfile2:
-            writer2 = csv.writer(csvfile2)
-            for line in Tx_reflected_signal: # [(time, signal_value),...]
-                writer2.writerow(line)
-            writer2.writerow([]) # space line for seperation from next call
+        record_signal('Tx_input_signal' + self.tag, Tx_input_signal, enabled=self.record_signals)
+        record_signal('Tx_reflected_signal' + self.tag, Tx_reflected_signal, enabled=self.record_signals)
+        self.last_signals = {'Tx_input_signal': Tx_input_signal, 'Tx_reflected_signal': Tx_reflected_signal}
         # Must delete before return, otherwise CST will save and raise popup window in next iteration
-        self.delete_results() # otherwise CST may raise popup window
-        self.delete_signal1() # otherwise CST may raise popup window
-        self.delete_port() # otherwise CST may raise popup window
+        with self.batch("fe teardown"):
+            self.delete_results() # otherwise CST may raise popup window
+            if not self.persistent_excitation:
+                self.delete_signal1() # otherwise CST may raise popup window
+                self.delete_port() # otherwise CST may raise popup window
         print(f"Return E_Path")
         return E_Path
 
     def plane_wave_excitation(self, excitePath=None):
         print("Start plane wave excitation")
-        # Import excitation file
-        if excitePath: 
-            print("pw: importing specified excitation file")
-            excitePath = os.getcwd() + "\\" + excitePath # getcwd so CST don't load cache
-            self.set_excitation(excitePath)
+        if self.persistent_excitation and not excitePath: # signal1 is imported from that file
+            raise ValueError("persistent_excitation needs an excitation file (specification excitePath)")
+        persistent = self.persistent_excitation
+        with self.batch("pw setup"):
+            # Import excitation file
+            if excitePath: 
+                print("pw: importing specified excitation file")
+                excitePath = os.getcwd() + "\\" + excitePath # getcwd so CST don't load cache
+            if persistent: self.persistent_setup("signal1", 1, excitePath)
+            else:
+                if excitePath: self.set_excitation(excitePath)
+                self.set_port(self.port[0], self.port[1])
+                self.set_plane_wave(self.incidence)
+            self.set_stimulation_plane_wave()
         ## Start simulation with plane wave
         print("pw: simulating")
-        self.set_port(self.port[0], self.port[1])
-        self.set_plane_wave()
-        self.start_simulate(plane_wave_excitation=True)
+        self.start_simulate()
         ## Export E field on patch to txt
-        E_Path = "txtf\E_received.txt"
-        outputPath = os.getcwd() + "\\" + E_Path
-        self.export_E_field(outputPath, "2D/3D Results\\E-Field\\E_field_on_patch [pw]", self.time_end, self.time_step, self.d)
-        print(f"pw: electric field exported as {outputPath}")
+        if self.export_fields:
+            E_Path = self.export_patch_field(f"txtf\\E_received{self.tag}.txt", "2D/3D Results\\E-Field\\E_field_on_patch [pw]")
+            print(f"pw: electric field exported as {E_Path}")
+        else: E_Path = None # received power only
         ## Legacy-----------------------------------
         # # Return power on feed, must set Result Template on CST by hand in advance (IDK how to do it by code)
         # print("pw: return power on feed")
@@ -471,38 +814,146 @@ class Controller(CSTInterface):
         # self.export_power(outputPath, "2D/3D Results\\Power Flow\\power_on_feed [pw]", self.time_end, self.time_step)
         # print(f"pw: power flow exported as {outputPath}")
         power_data = self.read('1D Results\\Port signals\\o1 [pw]')
-        powerPath = "txtf\power.txt"
-        file = open(powerPath, "w")
-        file.write("#\n#'Time / ns'	'default [Real Part]'\n#---------------------------------\n") # IDK why but don't change a word
-        for row in power_data:
-            file.write(f"{row[0]} {row[1]}\n")
-        file.close()
-        # Record Rx_signal to Rx_signal.csv
-        Rx_signal = self.read('1D Results\\Port signals\\o1 [pw]')
-        with open('results\\Rx_signal.csv', 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            for line in Rx_signal: # [(time, signal_value),...]
-                writer.writerow(line)
-            writer.writerow([]) # space line for seperation from next call
+        powerPath = f"txtf\\power{self.tag}.txt"
+        write_signal_file(powerPath, power_data)
+        # Record Rx_signal (same port signal as power_data)
+        record_signal('Rx_signal' + self.tag, power_data, enabled=self.record_signals)
+        self.last_signals = {'Rx_signal': power_data}
         ## Must delete before return, otherwise CST will save and raise popup window in next iteration
-        self.delete_results() # otherwise CST may raise popup window
-        self.delete_port() # otherwise CST may raise popup window
-        self.delete_plane_wave() # otherwise CST may raise popup window
+        with self.batch("pw teardown"):
+            self.delete_results() # otherwise CST may raise popup window
+            if not persistent:
+                self.delete_port() # otherwise CST may raise popup window
+                self.delete_plane_wave() # otherwise CST may raise popup window
         print(f"Return E_Path and powerPath")
         return E_Path, powerPath
 
 
+# Prepared base projects
+class StandInController:
+    '''
+    Base of the backends standing in for Controller without a local CST project (replay, job
+    queue, FDTD): the project setup calls are no-ops, subclasses provide update_distribution,
+    plane_wave_excitation and feed_excitation. symmetric only records that the run is xz symmetric.
+    '''
+    symmetric = False
+    record_signals = True # as Controller.record_signals
+
+    def set_base(self): pass
+    def set_domain(self): pass
+    def set_monitor(self): pass
+    def set_time_solver(self): pass
+    def xz_symmetric_boundary(self): self.symmetric = True
+    def delete_results(self): pass
+    def delete_signal1(self): pass
+    def save(self): pass
+    def close(self): pass
+
+
+class TemplateCache:
+    '''
+    Base project (base, domain, monitor, time solver, symmetric boundary) built once per
+    (grid, geometry, monitor timing, solver settings) key, then copied for every new working
+    project instead of replaying set_base/set_domain/... and their history rebuilds.
+    Projects created from a template need set_environment=False, specification(set_monitor=False)
+    and gradient_ascent(symmetric=False), since all of that is already in the copy.
+    '''
+    def __init__(self, folder="CST_Antennas\\templates", config=None, monitor_mode="volume"):
+        self.folder = os.path.abspath(folder)
+        self.config = DEFAULT_CONFIG if config is None else config
+        self.monitor_mode = monitor_mode # Controller.monitor_mode of the templates and created projects
+        os.makedirs(self.folder, exist_ok=True)
+
+    def key(self, time_step, time_end, symmetric=True):
+        c = self.config
+        values = (c.L, c.W, c.D, c.nx, c.ny, c.LG, c.WG, c.HC, c.HS, c.FEEDX, c.FEEDY, time_step, time_end, symmetric, "HF Time Domain")
+        if self.monitor_mode != "volume": values += (self.monitor_mode,) # volume keys stay as they were
+        return hashlib.sha1(repr(values).encode()).hexdigest()[:12], values
+
+    def template_path(self, time_step, time_end, symmetric=True):
+        key, values = self.key(time_step, time_end, symmetric)
+        path = os.path.join(self.folder, f"template_{key}.cst")
+        if not os.path.exists(path): self.build(path, values, time_step, time_end, symmetric)
+        return path
+
+    def build(self, path, values, time_step, time_end, symmetric):
+        print(f"Building template {path}...")
+        # Build under a temporary name so concurrent workers never copy a half built project
+        building = os.path.join(self.folder, f"building_{os.getpid()}.cst")
+        controller = Controller(building, self.config)
+        controller.time_step = time_step
+        controller.time_end = time_end
+        controller.monitor_mode = self.monitor_mode
+        controller.set_base()
+        controller.set_domain()
+        controller.set_monitor()
+        controller.set_time_solver()
+        if symmetric: controller.xz_symmetric_boundary()
+        controller.save()
+        controller.close_project()
+        if os.path.exists(path): # another worker finished first
+            copy_project(building, None)
+            return
+        copy_project(building, path, move=True)
+        with open(os.path.splitext(path)[0] + ".txt", "w") as file:
+            file.write("L, W, D, NX, NY, LG, WG, HC, HS, FEEDX, FEEDY, time_step, time_end, symmetric, solver" + (", monitor" if self.monitor_mode != "volume" else "") + "\n")
+            file.write(f"{values}\n")
+        print("Template built")
+
+    def create(self, fname, time_step, time_end, symmetric=True):
+        # New working project fname copied from the template, opened and ready for update_distribution
+        copy_project(self.template_path(time_step, time_end, symmetric), fname)
+        controller = Controller(fname, self.config)
+        controller.time_step = time_step
+        controller.time_end = time_end
+        controller.monitor_mode = self.monitor_mode
+        controller.symmetric = symmetric
+        return controller
+
+def copy_project(source, target, move=False):
+    # CST keeps project data in a folder next to the .cst file; target None deletes source
+    source_folder = os.path.splitext(source)[0]
+    if target is None:
+        os.remove(source)
+        if os.path.isdir(source_folder): shutil.rmtree(source_folder)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    target_folder = os.path.splitext(target)[0]
+    if os.path.isdir(target_folder): shutil.rmtree(target_folder)
+    if move:
+        if os.path.isdir(source_folder): os.replace(source_folder, target_folder)
+        os.replace(source, target)
+    else:
+        if os.path.isdir(source_folder): shutil.copytree(source_folder, target_folder)
+        shutil.copy2(source, target)
+
+
 # Optimizer Class
 class Optimizer:
-    def __init__(self, receiver = None, transmitter = None, set_environment=False):
-        # Operating domain
-        self.Ld = L
-        self.Wd = W
-        self.d = D
-        self.nx = NX
-        self.ny = NY
-        self.time_step = TSTEP
-        self.time_end = TEND
+    '''
+    Adjoint topology optimization with a receiver/transmitter controller pair (usually the same
+    Controller). Optional features, set before gradient_ascent:
+        optimizer.set_multi_spec([generator1, generator2], weights=[0.5, 0.5]) # several specs from one broadband Rx/Tx pair
+        optimizer.set_incidences([((0, 0, -1), (1, 0, 0)), ((0.5, 0, -0.866), (0.866, 0, 0.5))], controllers=[topop, topop2])
+        optimizer.precision = "float32" # halve field memory, see benchmark_precision.py
+        optimizer.memory_budget = 8 # GB, plan_memory picks parsing, gradient chunking and history storage to fit
+        optimizer.fidelity_schedule = "adaptive" # or [(0, "low"), (12, "medium"), (24, "high")], levels in FIDELITY
+        optimizer.quadtree = quadtree.QuadtreeDesign(optimizer.config, coarse=4)
+        optimizer.surrogate = surrogate.Surrogate() # or surrogate.surrogate_from_history("results")
+        optimizer.metrics = metrics.MetricsServer(port=8000, name=exp)
+        optimizer.registry, optimizer.exp = registry.Registry(), exp
+    '''
+    def __init__(self, receiver = None, transmitter = None, set_environment=False, config=None):
+        # Operating domain, taken from the receiver unless given
+        if config is None: config = getattr(receiver, "config", DEFAULT_CONFIG)
+        self.config = config
+        self.Ld = config.L
+        self.Wd = config.W
+        self.d = config.D
+        self.nx = config.nx
+        self.ny = config.ny
+        self.time_step = config.TSTEP
+        self.time_end = config.TEND
         self.excitePath = None # use CST default excitation for 1~3 GHz
         self.excitation_power = 1 # use CST default excitation for 1~3 GHz
         # Initiate controller (receiver and transmitter pair)
@@ -517,6 +968,55 @@ class Optimizer:
         self.Adam_var_init = np.array([np.zeros(self.nx*self.ny), np.zeros(self.nx*self.ny), np.zeros(self.nx*self.ny), np.zeros(self.nx*self.ny)]) # [m, v, m_hat, v_hat]
         self.power_init = 100
         self.received_power = 0
+        self.threshold = 0.95 # binarization threshold applied after every step
+        # "float32" or "float64" for parsed fields, Adam state and field caches; reductions accumulate in float64
+        self.precision = "float64"
+        # Surrogate pre-screening (surrogate.Surrogate): pick the step scale with best predicted power
+        self.surrogate = None
+        self.surrogate_scales = [0.5, 1, 2]
+        self.surrogate_prediction = None
+        # Live metrics (metrics.MetricsServer) and per-phase timing
+        self.metrics = None
+        self.current_phase = None
+        self.phase_start = time.time()
+        # Experiment registry (registry.Registry), run recorded under the name exp
+        self.registry = None
+        self.exp = None
+        self.run_id = None
+        self.spec_dic = None
+        # Multi-spec mode: gradients for several specs from one broadband Rx/Tx pair (see set_multi_spec)
+        self.spec_generators = None
+        self.spec_weights = None
+        self.broadband = None
+        self.spec_powers = None
+        self.spec_grads = None
+        # Memory budget in GB: plan_memory picks parse_mode, gradient_chunk and storage_mode to stay within it
+        self.memory_budget = None
+        self.memory_plan = None
+        self.parse_mode = "memory"
+        self.gradient_chunk = None # time samples per slice of the adjoint product, None for one shot
+        # History storage (signal store, topology history): "stream" writes every iteration,
+        # "memory" holds the run's history and writes it at the end of gradient_ascent
+        self.storage_mode = "stream"
+        self.held_topologies = [] # [(iteration, Topology),...] not yet written in memory mode
+        # Adaptive quadtree cells (quadtree.QuadtreeDesign), adapted every refine_period iterations;
+        # primal stays on the fine grid, uniform inside every cell
+        self.quadtree = None
+        self.refine_period = 5
+        # Solver fidelity schedule: None keeps the project settings, [(start_iteration, level),...]
+        # or "adaptive" (level raised as the fraction of changing pixels drops, never lowered)
+        self.fidelity_schedule = None
+        self.fidelity_levels = FIDELITY
+        self.fidelity_thresholds = [0.1, 0.02] # changed fraction below which medium, high are used
+        self.fidelity = None
+        # Multi-incidence mode: plane wave cases solved concurrently on several controllers (see set_incidences)
+        self.incidences = None
+        self.incidence_weights = None
+        self.incidence_controllers = None
+        self.incidence_powers = None
+        # Active set: freeze pixels stable for freeze_k iterations, re-check all every recheck_period
+        self.freeze_k = 5
+        self.recheck_period = 10
         # not important
         os.makedirs("./results", exist_ok=True)
         os.makedirs("./txtf", exist_ok=True)
@@ -540,30 +1040,60 @@ class Optimizer:
         # print("transmitter environment set")
 
     # Optimization core---------------------------------------------------------------------------------
-    def gradient_ascent(self, max_iter=36, linear_map=False, filter=False, Adam=False, symmetric=True):
+    def gradient_ascent(self, max_iter=36, linear_map=False, filter=False, Adam=False, symmetric=True, active_set=False):
         print("Executing gradient ascent:\n")
         '''
         Topology optimization gradient descent parameters:
         1. alpha is learning rate
         2. gamma is gaussian filter radius shrinking rate per iteration
         3. linear_map means linear or nonlinear conductivity mapping from [0,1] to actual conductivity
+        4. active_set freezes pixels whose binarized value and gradient sign stayed the same for
+           freeze_k iterations; frozen pixels are neither rewritten nor differentiated until the
+           next full re-check (every recheck_period iterations)
         '''
+        if active_set and filter:
+            print("Active set disabled: gaussian filter couples every pixel")
+            active_set = False
+        if active_set and self.quadtree is not None:
+            print("Active set disabled: quadtree cells couple their pixels")
+            active_set = False
         # Use symmetry to accelerate
+        if symmetric and self.incidences and any(normal[1] or e_vector[1] for normal, e_vector in self.incidences):
+            print("Symmetric boundary disabled: an incidence case is not symmetric about the xz plane")
+            symmetric = False
         if symmetric: 
-            self.receiver.xz_symmetric_boundary()
+            for controller in (self.incidence_controllers or [self.receiver]): controller.xz_symmetric_boundary()
             # self.transmitter.xz_symmetric_boundary()
         # Set up initial parameters
         primal = self.primal_init
-        adam_var = self.Adam_var_init
+        adam_var = np.array(self.Adam_var_init, self.dtype)
         discriminant = 0 # convergence detector
         radius = self.nx/4 # radius for gaussian filter
         ones = np.ones(self.nx*self.ny) # easier to read the code, not important
         # last_grad_CST = np.zeros(self.nx*self.ny) # Initial grad_CST of descent
+        # Active set bookkeeping
+        active = np.ones(self.nx*self.ny, dtype=bool)
+        stable_count = np.zeros(self.nx*self.ny, dtype=int)
+        last_sign = np.zeros(self.nx*self.ny)
+        last_binary = -np.ones(self.nx*self.ny)
+        last_primal = None # fidelity schedule measures how much the topology still changes
+        # Quadtree: primal and Adam state uniform per cell, cells written before the first solve
+        cells_changed = self.quadtree is not None
+        if self.quadtree is not None:
+            primal = self.quadtree.project(primal)
+            adam_var = np.array([self.quadtree.project(var) for var in adam_var], self.dtype)
         
         # Gradient ascent loop
         start_time = time.time()
+        if self.metrics is not None: self.metrics.update(status='running', iter_init=self.iter_init, max_iter=max_iter, started=start_time)
+        if self.memory_budget is not None and self.memory_plan is None: self.plan_memory(max_iter)
+        signal_store().set_mode(self.storage_mode)
+        if self.registry is not None: self.register_run(max_iter=max_iter, linear_map=linear_map, filter=filter, Adam=Adam, symmetric=symmetric, active_set=active_set)
         for index in range(self.iter_init, max_iter): # maximum iterations if doesn't converge
             print(f"\nIteration{index}:")
+            iteration_start = time.time()
+            signal_store().iteration = index # port signals of this iteration are stored under index
+            if self.metrics is not None: self.metrics.update(iteration=index)
             # Map and calculate gradient
             # map unit to full
             if linear_map: 
@@ -583,13 +1113,33 @@ class Optimizer:
                 cond_smoothed = cond_smoothed.ravel()
             else: cond_smoothed = cond
                 
+            if cells_changed:
+                self.apply_cells(cond_smoothed, index)
+                cells_changed = False
+
+            # Pick solver fidelity for this iteration
+            changed = None if last_primal is None else np.mean(np.abs(primal - last_primal) > 0.1)
+            last_primal = primal.copy()
+            self.select_fidelity(index, changed)
+
             # Calculate gradient by adjoint method
+            if active_set and index > self.iter_init and (index-self.iter_init) % self.recheck_period == 0:
+                print("Active set: re-checking frozen pixels")
+                active[:] = True
             it_start_time = time.time()
-            grad_CST = self.calculate_gradient(cond_smoothed)
+            if active_set: 
+                print(f"active pixels = {np.count_nonzero(active)}/{active.size}")
+                grad_CST = self.calculate_gradient(cond_smoothed, active)
+            else: grad_CST = self.calculate_gradient(cond_smoothed)
+            if self.quadtree is not None: # per cell mean of the fine gradient, spread uniformly over the cell
+                grad_fine = grad_CST
+                grad_CST = self.quadtree.project(grad_fine)
             it_end_time = time.time()
             print("iteration time =", it_end_time-it_start_time)
+            if self.surrogate is not None: self.surrogate.check(self.surrogate_prediction, self.received_power, index)
 
             # Record conductivity (smoothed)
+            self.set_phase("record")
             file = open(self.results_history_path['cond'], "a")
             file.write(f"Iteration{index}, filter_radius={radius}\n")
             file.write(f"{cond_smoothed}\n")
@@ -599,10 +1149,15 @@ class Optimizer:
             file.write(f"Iteration{index}\n")
             file.write(f"{primal}\n")
             file.close()
-            # Record grad_CST
-            rms_grad_CST = np.sqrt(np.mean(grad_CST**2))
+            if Topology.is_binary(primal):
+                if self.storage_mode == "memory": self.held_topologies.append((index, self.solved_topology(primal)))
+                else: append_topology("results\\topology_history.bin", index, self.solved_topology(primal))
+            # Record grad_CST (frozen pixels recorded as 0 so history keeps full length)
+            if active_set: rms_grad_CST = np.sqrt(np.mean(grad_CST[active]**2))
+            else: rms_grad_CST = np.sqrt(np.mean(grad_CST**2))
             file = open(self.results_history_path['grad_CST'], "a")
-            file.write(f"Iteration{index}, rms_grad_CST={rms_grad_CST}\n")
+            if active_set: file.write(f"Iteration{index}, rms_grad_CST={rms_grad_CST}, active={np.count_nonzero(active)}\n")
+            else: file.write(f"Iteration{index}, rms_grad_CST={rms_grad_CST}\n")
             file.write(f"{grad_CST}\n")
             file.close() 
 
@@ -620,27 +1175,48 @@ class Optimizer:
             #     # cond_by_primal = 5.8e7 * np.exp(-primal)/(ones + np.exp(-primal))**2 * 0.1**4 # sigmoid (0.1^4 because time and volume differential)
             #     cond_by_primal = ones # won't converge adjustment
             # grad_primal = grad_cond * cond_by_primal
+            self.set_phase("step")
             grad_primal = grad_CST
             step = grad_primal
             # Apply Adam algorithm
-            if Adam: step, adam_var = self.Adam(grad_primal, index, adam_var)
-            primal = primal + self.alpha * step
+            if Adam: step, adam_var = self.Adam(grad_primal, index, adam_var, active if active_set else None)
+            if active_set: step = np.where(active, step, 0)
+            if self.surrogate is None: primal = primal + self.alpha * step
+            else: primal = self.surrogate_step(primal, step, grad_CST)
 
             # Experimental. Assume mostly saddle points and self penalty trivial, we can clip to 0,1 for faster simulation in next iteration. 20250404
             if index >= 0:
-                threshold = 0.95
-                for index, val in enumerate(primal):
-                    if val < threshold: primal[index] = 0
-                    else: primal[index] = 1
+                primal = np.where(primal < self.threshold, 0.0, 1.0)
+
+            # Split and merge quadtree cells every refine_period iterations
+            if self.quadtree is not None and (index-self.iter_init+1) % self.refine_period == 0:
+                if self.quadtree.adapt(grad_fine, primal):
+                    primal = np.where(self.quadtree.project(primal) < 0.5, 0.0, 1.0)
+                    adam_var = np.array([self.quadtree.project(var) for var in adam_var], self.dtype)
+                    cells_changed = True
+
+            # Freeze pixels sitting at 0 or 1 whose gradient keeps pushing them into the bound
+            if active_set:
+                sign = np.sign(grad_CST)
+                pushing = ((primal == 1) & (sign > 0)) | ((primal == 0) & (sign < 0))
+                steady = active & pushing & (sign == last_sign) & (primal == last_binary)
+                stable_count = np.where(steady, stable_count+1, np.where(active, 0, stable_count))
+                last_sign = np.where(active, sign, last_sign)
+                last_binary = primal.copy()
+                active = stable_count < self.freeze_k
 
             # Print rms to see overall trend
+            rms_step = np.sqrt(np.mean(step**2))
             print(f"rms_grad_CST = {rms_grad_CST}")
-            print(f"rms_step = {np.sqrt(np.mean(step**2))}")
+            print(f"rms_step = {rms_step}")
             # Record step
             file = open(self.results_history_path['step'], "a")
-            file.write(f"Iteration{index}, rms_step={np.sqrt(np.mean(step**2))}\n")
+            file.write(f"Iteration{index}, rms_step={rms_step}\n")
             file.write(f"{step}\n")
             file.close()
+            self.set_phase(None)
+            if self.metrics is not None: self.report_metrics(time.time()-iteration_start, rms_grad_CST, rms_step)
+            if self.registry is not None: self.registry.log_iteration(self.run_id, index, self.received_power, rms_grad_CST, rms_step, time.time()-iteration_start)
 
             # Discriminant
             if index == 0: self.power_init = self.received_power
@@ -659,16 +1235,128 @@ class Optimizer:
                 radius *= self.gamma
             else: pass
         if discriminant <= 5: print(f"Problem unsolvable in {index+1} iterations")
+        signal_store().iteration = None
+        self.write_history()
+        if self.metrics is not None: self.metrics.update(status='done', phase=None)
+        if self.registry is not None: self.finish_registered_run()
+        if hasattr(self.receiver, "batch_report"): self.receiver.batch_report()
         
 
-    def calculate_gradient(self, cond):
+    def write_history(self):
+        # history held in storage_mode "memory" goes to disk
+        signal_store().flush()
+        for iteration, topology in self.held_topologies: append_topology("results\\topology_history.bin", iteration, topology)
+        self.held_topologies = []
+
+    def set_phase(self, name):
+        # Close the running phase (its duration goes to metrics) and start the next one
+        now = time.time()
+        if self.metrics is not None:
+            if self.current_phase is not None: self.metrics.add_duration(self.current_phase, now - self.phase_start)
+            self.metrics.set_phase(name)
+        self.current_phase = name
+        self.phase_start = now
+
+    def report_metrics(self, seconds, rms_grad, rms_step):
+        self.metrics.update(received_power=self.received_power, rms_grad=rms_grad, rms_step=rms_step)
+        self.metrics.end_iteration(seconds)
+        hits = getattr(self.receiver, "hits", None) # replay backend
+        if hits: self.metrics.set_cache("replay_exact", hits['exact'], hits['nearest'])
+
+    def apply_distribution(self, controller, cond, pixels=None):
+        # quadtree: controllers with cells get one value per cell, others the (cell uniform) fine grid
+        if self.quadtree is not None and hasattr(controller, "set_cells"): controller.update_distribution(self.quadtree.restrict(cond))
+        else: controller.update_distribution(cond, pixels)
+
+    def apply_cells(self, cond, index):
+        # (re)build the cell bricks on every controller and record the cell layout
+        for controller in (self.incidence_controllers or [self.receiver]):
+            if hasattr(controller, "set_cells"): controller.set_cells(self.quadtree.boxes(), self.quadtree.restrict(cond))
+            else: print("Backend has no cells, fine grid kept (uniform per cell)")
+        with open('results\\quadtree_history.txt', 'a') as file:
+            file.write(f"Iteration{index}, cells={len(self.quadtree)} ({self.quadtree.describe()})\n")
+            file.write(f"{self.quadtree.cells}\n")
+
+    def select_fidelity(self, index, changed):
+        # changed: fraction of pixels moved by the last step, None in the first iteration
+        if self.fidelity_schedule is None: return None
+        levels = list(self.fidelity_levels)
+        if self.fidelity_schedule == "adaptive":
+            rank = 0
+            if changed is not None: rank = sum(changed < threshold for threshold in self.fidelity_thresholds)
+            if self.fidelity in levels: rank = max(rank, levels.index(self.fidelity)) # never step back
+            level = levels[min(rank, len(levels)-1)]
+        else:
+            level = self.fidelity
+            for start, name in sorted(self.fidelity_schedule):
+                if index >= start: level = name
+            if level is None: return None # schedule starts later, project settings until then
+        if level != self.fidelity:
+            print(f"Solver fidelity: {level} {self.fidelity_levels[level]}")
+            # every controller that solves, so multi-incidence cases are summed at one fidelity
+            controllers = list(self.incidence_controllers or [self.receiver])
+            if self.transmitter is not None and all(self.transmitter is not c for c in controllers): controllers.append(self.transmitter)
+            for controller in controllers:
+                if hasattr(controller, "set_fidelity"): controller.set_fidelity(level, self.fidelity_levels[level])
+                else: print("Backend has no fidelity settings, recorded only")
+            self.fidelity = level
+        if self.metrics is not None: self.metrics.update(fidelity=level)
+        with open('results\\fidelity.csv', 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([index, level, changed] + list(self.fidelity_levels[level].values()))
+        return level
+
+    def register_run(self, **options):
+        config = dict(asdict(self.config), alpha=self.alpha, gamma=self.gamma, threshold=self.threshold,
+                      fidelity_schedule=self.fidelity_schedule,
+                      precision=self.precision, iter_init=self.iter_init, surrogate=self.surrogate is not None,
+                      backend=type(self.receiver).__name__, **options)
+        if self.spec_generators: spec = {'specs': [g.spec_dic for g in self.spec_generators], 'weights': self.spec_weights}
+        else: spec = self.spec_dic or {}
+        if self.incidences: spec = dict(spec, incidences=self.incidences, incidence_weights=self.incidence_weights)
+        self.run_id = self.registry.start_run(self.exp, config, spec, "results")
+
+    def finish_registered_run(self):
+        for kind, path in self.results_history_path.items(): self.registry.add_artifact(self.run_id, kind, path)
+        self.registry.add_artifact(self.run_id, "total_power", "results\\total_power.csv")
+        self.registry.add_artifact(self.run_id, "signals", "results\\signals")
+        self.registry.finish_run(self.run_id)
+
+    def solved_topology(self, binary):
+        # Topology of what the receiver solves, the y>=0 half only on symmetric projects
+        return Topology.from_binary(binary, self.config.solved_half(getattr(self.receiver, "symmetric", False), np.size(binary)))
+
+    def surrogate_step(self, primal, step, grad):
+        # Line search on the surrogate, only the most promising step scale goes to the solver
+        self.surrogate.add(primal, self.received_power, grad)
+        candidates = {} # scales that binarize to the same topology are screened once
+        for scale in self.surrogate_scales:
+            candidate = np.where(primal + self.alpha*scale*step < self.threshold, 0.0, 1.0)
+            candidates.setdefault(self.solved_topology(candidate), (scale, candidate))
+        scales, candidates = zip(*candidates.values())
+        chosen, predicted = self.surrogate.screen(candidates, top_k=1)
+        if predicted is None: # not enough samples yet
+            self.surrogate_prediction = None
+            return primal + self.alpha * step
+        self.surrogate_prediction = predicted[0]
+        print(f"surrogate: step scale {scales[chosen[0]]} chosen ({len(candidates)} distinct), predicted power = {predicted[0]}")
+        return candidates[chosen[0]]
+
+    def calculate_gradient(self, cond, active=None):
         print("Calculating gradient...")
+        if self.spec_generators: return self.calculate_multi_spec_gradient(cond, active)
+        if self.incidences: return self.calculate_multi_incidence_gradient(cond, active)
+        # active: boolean mask of pixels to rewrite and differentiate, None for all
+        pixels = None if active is None else np.flatnonzero(active)
         # Receiver do plane wave excitation, export E and power
         print("Updating receiver conductivity distribution...")
-        self.receiver.update_distribution(cond)
+        self.set_phase("update distribution")
+        self.apply_distribution(self.receiver, cond, pixels)
         print("Calculating receiver field...")
+        self.set_phase("rx solve")
         Er_Path, powerPath = self.receiver.plane_wave_excitation(self.excitePath)
         # Transmitter do time reverse excitation
+        self.set_phase("tx solve")
         feedPath = self.power_time_reverse(powerPath)
         # print("Updating transmitter conductivity distribution...")
         # self.transmitter.update_distribution(cond)
@@ -676,8 +1364,10 @@ class Optimizer:
         Et_Path = self.transmitter.feed_excitation(feedPath)
         # Calculate gradient by adjoint field method
         print("Calculating gradient by adjoint method...")
-        E_received = self.Efile2gridE(Er_Path)
-        E_excited = self.Efile2gridE(Et_Path)
+        self.set_phase("parse")
+        E_received = self.Efile2gridE(Er_Path, pixels)
+        E_excited = self.Efile2gridE(Et_Path, pixels)
+        self.set_phase("gradient")
         # Some strange bug from CST (I think it's because of early convergence of time solver)
         len_r = len(E_received)
         len_e = len(E_excited)
@@ -687,10 +1377,142 @@ class Optimizer:
         elif len_r < len_e: E_excited = E_excited[:len_r]
         else: pass
         # grad = np.flip(E_received,0)*E_excited # adjoint method
-        grad = np.sum(np.flip(E_received,0) * E_excited, axis=2)
-        grad = np.sum(grad, axis=0) # adjoint method continued (see paper: "Topology Optimization of Metallic Antenna")
+        # sum over time and components (see paper: "Topology Optimization of Metallic Antenna"), float64 accumulator
+        grad = adjoint_gradient(E_received, E_excited, self.gradient_chunk)
+        if pixels is not None: # scatter active gradient back, frozen pixels get 0
+            grad_full = np.zeros(len(cond))
+            grad_full[pixels] = grad
+            grad = grad_full
+        return grad
+
+    def calculate_multi_spec_gradient(self, cond, active=None):
+        '''
+        Received power and adjoint gradient for every generator in self.spec_generators from a
+        single Rx/Tx pair excited by the broadband pulse. The solver is linear, so the response
+        to spec k is the broadband response filtered by S_k/B (regularized deconvolution):
+        - Rx: o_k = o_b * S_k/B and E_r,k = E_r,b * S_k/B
+        - Tx: the adjoint excitation is reversed o_k, so E_t,k = E_t,b * R_k/B
+        Returns the spec_weights-weighted gradient, per spec results kept in spec_powers/spec_grads.
+        '''
+        print("Calculating multi-spec gradient from broadband pair...")
+        pixels = None if active is None else np.flatnonzero(active)
+        self.set_phase("update distribution")
+        self.apply_distribution(self.receiver, cond, pixels)
+        print("Calculating receiver field (broadband)...")
+        self.set_phase("rx solve")
+        Er_Path, powerPath = self.receiver.plane_wave_excitation(self.broadband.excitePath)
+        print("Calculating transmitter field (broadband)...")
+        self.set_phase("tx solve")
+        Et_Path = self.transmitter.feed_excitation(self.broadband.excitePath)
+        self.set_phase("parse")
+        E_received = self.Efile2gridE(Er_Path, pixels)
+        E_excited = self.Efile2gridE(Et_Path, pixels)
+        self.set_phase("gradient")
+        n = min(len(E_received), len(E_excited))
+        E_received, E_excited = E_received[:n], E_excited[:n]
+        # Everything on the monitor time grid, zero padded to 2n against circular wrap-around
+        grid = np.arange(n) * self.time_step
+        port = np.loadtxt(powerPath, skiprows=3) # First three lines are titles
+        o_b = np.interp(grid, port[:,0], port[:,1], right=0)
+        b = np.interp(grid, self.broadband.t, self.broadband.signal, right=0)
+        B = rfft(b, 2*n)
+        B_inv = np.conj(B) / (np.abs(B)**2 + 1e-3*np.max(np.abs(B))**2)
+        O_b = rfft(o_b, 2*n)
+        # scipy keeps float32 fields in complex64
+        E_r_f = rfft(E_received, 2*n, axis=0)
+        E_t_f = rfft(E_excited, 2*n, axis=0)
+        self.spec_powers = []
+        self.spec_grads = []
+        for generator in self.spec_generators:
+            s = np.interp(grid, generator.t, generator.signal, right=0)
+            H = rfft(s, 2*n) * B_inv
+            o_k = irfft(O_b * H, 2*n)[:n]
+            power = np.sum(np.abs(o_k)) * self.time_step / generator.power
+            R = rfft(np.flip(o_k), 2*n) * B_inv
+            E_r_k = irfft(E_r_f * H.astype(E_r_f.dtype)[:, None, None], 2*n, axis=0)[:n]
+            E_t_k = irfft(E_t_f * R.astype(E_t_f.dtype)[:, None, None], 2*n, axis=0)[:n]
+            grad = np.sum(np.flip(E_r_k,0) * E_t_k, axis=(0,2), dtype=np.float64)
+            if pixels is not None: # scatter active gradient back, frozen pixels get 0
+                grad_full = np.zeros(len(cond))
+                grad_full[pixels] = grad
+                grad = grad_full
+            self.spec_powers.append(power)
+            self.spec_grads.append(grad)
+        weights = self.spec_weights if self.spec_weights is not None else np.ones(len(self.spec_generators))
+        self.received_power = float(np.dot(weights, self.spec_powers))
+        print("spec powers =", self.spec_powers)
+        # Record per spec power, weighted sum goes to total_power.csv as usual
+        with open('results\\multi_spec_power.csv', 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self.spec_powers)
+        with open('results\\total_power.csv', 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([self.received_power])
+        return np.tensordot(weights, np.array(self.spec_grads), axes=1)
+
+    def calculate_multi_incidence_gradient(self, cond, active=None):
+        '''
+        Received power and adjoint gradient of every plane wave case in self.incidences. Cases are
+        spread over self.incidence_controllers, each controller solves its cases (Rx, then Tx with
+        the reversed port signal) one after the other, controllers run concurrently.
+        Returns the incidence_weights-weighted gradient, per case powers kept in incidence_powers.
+        '''
+        print(f"Calculating gradient for {len(self.incidences)} incidence cases...")
+        pixels = None if active is None else np.flatnonzero(active)
+        controllers = self.incidence_controllers
+        def solve(slot):
+            controller = controllers[slot]
+            self.apply_distribution(controller, cond, pixels)
+            results = []
+            for case in range(slot, len(self.incidences), len(controllers)):
+                start = time.time()
+                controller.incidence = self.incidences[case]
+                Er_Path, powerPath = controller.plane_wave_excitation(self.excitePath)
+                power, feedPath = self.case_time_reverse(powerPath, controller.tag)
+                Et_Path = controller.feed_excitation(feedPath)
+                E_received = self.Efile2gridE(Er_Path, pixels)
+                E_excited = self.Efile2gridE(Et_Path, pixels)
+                n = min(len(E_received), len(E_excited))
+                grad = adjoint_gradient(E_received[:n], E_excited[:n], self.gradient_chunk)
+                print(f"case {case} {self.incidences[case]}: power = {power}, {time.time()-start:.1f} s")
+                results.append((case, power, grad))
+            return results
+        self.set_phase("incidence cases")
+        powers = np.zeros(len(self.incidences))
+        grads = np.zeros((len(self.incidences), len(cond) if pixels is None else len(pixels)))
+        with ThreadPoolExecutor(len(controllers)) as pool:
+            for results in pool.map(solve, range(len(controllers))):
+                for case, power, grad in results:
+                    powers[case] = power
+                    grads[case] = grad
+        self.set_phase("gradient")
+        weights = self.incidence_weights if self.incidence_weights is not None else np.ones(len(self.incidences))
+        self.incidence_powers = powers
+        self.received_power = float(np.dot(weights, powers))
+        print("incidence powers =", powers)
+        # Record per case power, weighted sum goes to total_power.csv as usual
+        with open('results\\multi_incidence_power.csv', 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(powers)
+        with open('results\\total_power.csv', 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([self.received_power])
+        grad = np.tensordot(weights, grads, axes=1)
+        if pixels is not None: # scatter active gradient back, frozen pixels get 0
+            grad_full = np.zeros(len(cond))
+            grad_full[pixels] = grad
+            grad = grad_full
         return grad
 
+    def case_time_reverse(self, powerPath, tag):
+        # power_time_reverse for one incidence case: own feed file, nothing recorded
+        signal = np.loadtxt(powerPath, skiprows=3) # First three lines are titles
+        dt = np.diff(signal[:,0], prepend=0.0)
+        power = np.sum(np.abs(signal[:,1]) * dt) / self.excitation_power
+        feedPath = f"txtf\\reversed_power{tag}.txt"
+        write_signal_file(feedPath, np.stack([signal[:,0], np.flip(signal[:,1])], axis=1))
+        return power, feedPath
+
     # Adjoint method -------------------------------------------------------------------------------
     def power_time_reverse(self, powerPath):
         print("Executing time reversal...")
@@ -748,40 +1570,36 @@ class Optimizer:
         print(f"reversed power exported as '{feedPath}'")
         return feedPath
     
-    def Efile2gridE(self, path):
-        file1 = open(path,'r')
-        grid_E = []
-        time = []
-        for line in file1.readlines()[2:]: # First two lines are titles
-            if not (line.startswith('Sample')):
-                line = line.split() # x,y,z,Ex,Ey,Ez
-                # E_abs_square = 0
-                # for word in line[:2:-1]: # Ez, Ey, Ex (because I want final word = Ex)
-                #     word = float(word)
-                #     E_abs_square += word**2
-                # time.append(E_abs_square**(1/2)*np.sign(word))
-                # E_x = float(line[3])
-                # time.append(E_x)
-                E_vec = [float(line[3]), float(line[4]), float(line[5])]
-                time.append(E_vec)
-            else:
-                grid_E.append(time)
-                time = []
-        grid_E = grid_E[1:] # delete initial []
-        file1.close()
-        grid_E = np.array(grid_E) # [t0, t1, ...tk=[|E_1|,...|E_k|...,|E_169|],...tn]
-        return grid_E
+    def Efile2gridE(self, path, pixels=None):
+        return read_E_file(path, pixels, self.dtype, self.parse_mode)
+
+    def plan_memory(self, max_iter=36):
+        # choose parse, gradient and storage modes for memory_budget (GB), call after specification to see it up front
+        samples = 0 if self.surrogate is None else len(self.surrogate.y) + max_iter - self.iter_init
+        self.memory_plan = plan_memory(self.config, self.time_step, self.time_end, self.memory_budget, self.dtype,
+                                       len(self.spec_generators or []), samples, max_iter - self.iter_init,
+                                       3*len(self.incidences or [None]))
+        self.parse_mode = self.memory_plan['parse']
+        self.gradient_chunk = self.memory_plan['gradient_chunk']
+        self.storage_mode = self.memory_plan['storage']
+        return self.memory_plan
+
+    @property
+    def dtype(self):
+        return np.dtype(self.precision)
 
     # Descent algorithm---------------------------------------------------------------------------------------
-    def Adam(self, gradient, iteration, adam_var):
+    def Adam(self, gradient, iteration, adam_var, active=None):
         iteration = iteration + 1
         beta1 = 0.9  # Decay rate for first moment
         beta2 = 0.999  # Decay rate for second moment
         epsilon = 1e-8  # Small value to prevent division by zero
+        # Frozen pixels (active set) keep their moments instead of decaying towards 0
+        if active is None: active = np.ones(len(gradient), dtype=bool)
         # Update biased first moment estimate
-        adam_var[0] = beta1 * adam_var[0] + (1 - beta1) * gradient
+        adam_var[0] = np.where(active, beta1 * adam_var[0] + (1 - beta1) * gradient, adam_var[0])
         # Update biased second moment estimate
-        adam_var[1] = beta2 * adam_var[1] + (1 - beta2) * (gradient ** 2)
+        adam_var[1] = np.where(active, beta2 * adam_var[1] + (1 - beta2) * (gradient ** 2), adam_var[1])
         # Compute bias-corrected first and second moment estimates
         adam_var[2] = adam_var[0] / (1 - beta1 ** iteration + epsilon)
         adam_var[3] = adam_var[1] / (1 - beta2 ** iteration + epsilon)
@@ -802,6 +1620,7 @@ class Optimizer:
             self.time_step = spec_dic["time_step"]
             self.excitePath = spec_dic["excitePath"]
             self.excitation_power = spec_dic["power"]
+            self.spec_dic = spec_dic
             ## Reset impulse time informtion for controller
             self.receiver.time_step = self.time_step
             self.receiver.time_end = self.time_end
@@ -815,16 +1634,335 @@ class Optimizer:
             # self.transmitter.set_monitor()
         else: print("Specification: Use monitor from last history entry, make sure same time interval are used.")
 
+    def set_multi_spec(self, generators, weights=None, set_monitor=True):
+        '''
+        Evaluate several specs (generated Excitation_Generator objects) from one broadband
+        simulation pair per iteration instead of regenerating the excitation and rerunning.
+        '''
+        self.spec_generators = generators
+        self.spec_weights = None if weights is None else np.array(weights, float)
+        self.broadband = Excitation_Generator()
+        self.broadband.generate_broadband(generators)
+        print("Broadband spec_dictionary:", self.broadband.spec_dic)
+        self.specification(self.broadband.spec_dic, set_monitor)
+
+    def set_incidences(self, incidences, weights=None, controllers=None, set_monitor=True):
+        '''
+        Optimize for several plane wave cases [(normal, E vector),...] at once, e.g.
+            [((0, 0, -1), (1, 0, 0)), ((0.5, 0, -0.866), (0.866, 0, 0.5))]
+        controllers: solver instances the cases are spread over (each runs its own Rx and Tx),
+        prepared like the receiver (TemplateCache.create is the easy way), default the receiver only.
+        '''
+        self.incidences = [tuple(tuple(v) for v in case) for case in incidences]
+        self.incidence_weights = None if weights is None else np.array(weights, float)
+        self.incidence_controllers = list(controllers) if controllers else [self.receiver]
+        for slot, controller in enumerate(self.incidence_controllers):
+            if len(self.incidence_controllers) > 1: controller.tag = f"_s{slot}"
+            if controller is self.receiver: continue
+            controller.time_step = self.time_step
+            controller.time_end = self.time_end
+            if set_monitor: controller.set_monitor()
+        print(f"{len(self.incidences)} incidence cases on {len(self.incidence_controllers)} controllers")
+
     # just for convenience-------------------------------------------------------------------------
     def clean_results(self):
         print("Cleaning result legacy...")
         folder = os.getcwd() + "/results"
         for file in os.listdir(folder): 
             file = folder + "/" + file
-            os.remove(file)
+            if os.path.isdir(file): shutil.rmtree(file) # e.g. results/signals
+            else: os.remove(file)
         print("All files deleted successfully.")
 
 
+# Field and signal files--------------------------------------------------------------------------
+def read_E_file(path, pixels=None, dtype=np.float64, mode="memory"):
+    # pixels: only parse these rows of each time sample (active set), None for all
+    # mode: "memory", "stream" (parse into a preallocated array) or "memmap" (into path.mmap on disk), see plan_memory
+    if path.endswith('.npy'): # binary field written by replay backend
+        grid_E = np.load(path, mmap_mode='r' if mode == "memmap" else None)
+        if mode == "memmap" and pixels is None and grid_E.dtype == dtype: return grid_E
+        grid_E = np.asarray(grid_E).astype(dtype, copy=False)
+        return grid_E if pixels is None else grid_E[:, pixels]
+    if mode != "memory": return stream_E_file(path, pixels, dtype, mode == "memmap")
+    wanted = None if pixels is None else set(pixels)
+    file1 = open(path,'r')
+    grid_E = []
+    time = []
+    position = 0 # row index inside current time sample
+    for line in file1.readlines()[2:]: # First two lines are titles
+        if not (line.startswith('Sample')):
+            position += 1
+            if wanted is not None and position-1 not in wanted: continue
+            line = line.split() # x,y,z,Ex,Ey,Ez
+            # E_abs_square = 0
+            # for word in line[:2:-1]: # Ez, Ey, Ex (because I want final word = Ex)
+            #     word = float(word)
+            #     E_abs_square += word**2
+            # time.append(E_abs_square**(1/2)*np.sign(word))
+            # E_x = float(line[3])
+            # time.append(E_x)
+            E_vec = [float(line[3]), float(line[4]), float(line[5])]
+            time.append(E_vec)
+        else:
+            grid_E.append(time)
+            time = []
+            position = 0
+    grid_E = grid_E[1:] # delete initial []
+    file1.close()
+    grid_E = np.array(grid_E, dtype) # [t0, t1, ...tk=[|E_1|,...|E_k|...,|E_169|],...tn]
+    return grid_E
+
+def grid_E_file(path, config=None, dtype=np.float64):
+    '''
+    Convert a plane mode export (pixel centers, see Controller.set_plane_monitor) into a .npy of
+    shape (time, pixel, 3) in grid order (index_map, x fastest). The coordinates of the first time
+    sample are matched to the pixel centers, so the row order CST writes doesn't matter; a grid
+    mismatch raises instead of silently scrambling the gradient. Returns the .npy path.
+    '''
+    config = DEFAULT_CONFIG if config is None else config
+    pixels = config.pixels
+    data = np.loadtxt(path, skiprows=2, comments='Sample', ndmin=2) # x,y,z,Ex,Ey,Ez rows, 'Sample' lines skipped
+    samples = len(data) // pixels
+    if samples == 0 or samples*pixels != len(data):
+        raise ValueError(f"{path}: {len(data)} rows is not a whole number of samples of {pixels} pixels, check the monitor mode")
+    xi = np.rint((data[:pixels, 0] + config.L/2)/config.D - 0.5).astype(int)
+    yi = np.rint((data[:pixels, 1] + config.W/2)/config.D - 0.5).astype(int)
+    inside = (xi >= 0) & (xi < config.nx) & (yi >= 0) & (yi < config.ny)
+    if not inside.all(): raise ValueError(f"{path}: {np.count_nonzero(~inside)} points outside the design grid")
+    index = config.index_map[yi, xi]
+    offset = np.abs(data[:pixels, :2] - config.pixel_centers[index])
+    if np.unique(index).size != pixels or np.max(offset) > config.D/10:
+        raise ValueError(f"{path}: exported points are not the pixel centers")
+    row = np.empty(pixels, int) # row of every pixel inside a sample
+    row[index] = np.arange(pixels)
+    # read_E_file drops the last exported sample, keep the same number of samples
+    grid_E = data[:(samples-1)*pixels, 3:6].reshape(samples-1, pixels, 3)[:, row].astype(dtype)
+    npy_path = os.path.splitext(path)[0] + ".npy"
+    np.save(npy_path, grid_E)
+    return npy_path
+
+def stream_E_file(path, pixels=None, dtype=np.float64, memmap=False):
+    # Same result as read_E_file without the intermediate python lists: count samples and rows
+    # first (no float parsing), then fill a preallocated (or memory-mapped) array line by line
+    samples, rows, position = -1, 0, 0
+    with open(path, 'r') as file:
+        for line in itertools.islice(file, 2, None):
+            if line.startswith('Sample'):
+                samples += 1
+                rows = max(rows, position)
+                position = 0
+            else: position += 1
+    wanted = np.arange(rows) if pixels is None else np.asarray(pixels)
+    row_of = -np.ones(rows, int) # file row -> array row, -1 skipped
+    row_of[wanted] = np.arange(len(wanted))
+    shape = (max(samples, 0), len(wanted), 3)
+    if memmap: grid_E = np.lib.format.open_memmap(os.path.splitext(path)[0] + ".mmap.npy", mode='w+', dtype=dtype, shape=shape)
+    else: grid_E = np.empty(shape, dtype)
+    sample, position = -1, 0
+    with open(path, 'r') as file:
+        for line in itertools.islice(file, 2, None):
+            if line.startswith('Sample'):
+                sample += 1
+                position = 0
+                continue
+            if 0 <= sample < shape[0] and row_of[position] >= 0:
+                values = line.split()
+                grid_E[sample, row_of[position]] = (float(values[3]), float(values[4]), float(values[5]))
+            position += 1
+    # read_E_file drops the samples before the first and after the last 'Sample' line the same way
+    return grid_E
+
+def adjoint_gradient(E_received, E_excited, chunk=None):
+    # sum over time and components of flip(E_r)*E_t, float64 accumulator; chunk: time samples per
+    # slice so the product temporary stays small (and memory-mapped fields are read slice by slice)
+    n = len(E_excited)
+    if chunk is None or chunk >= n: return np.sum(np.flip(E_received,0) * E_excited, axis=(0,2), dtype=np.float64)
+    grad = np.zeros(E_excited.shape[1])
+    for t0 in range(0, n, chunk):
+        t1 = min(t0 + chunk, n)
+        grad += np.sum(np.flip(E_received[n-t1:n-t0],0) * E_excited[t0:t1], axis=(0,2), dtype=np.float64)
+    return grad
+
+# Memory planner----------------------------------------------------------------------------------
+BASE_MEMORY = 400 * 2**20 # interpreter, numpy, scipy, matplotlib and CST python libraries
+LIST_BYTES = 184 # python float objects and row lists read_E_file builds per (sample, pixel)
+
+def plan_memory(config, time_step, time_end, budget, dtype=np.float64, specs=0, surrogate_samples=0, iterations=0, signals=3):
+    '''
+    Estimate peak memory per stage of an iteration and pick parse/gradient/storage modes within budget (GB):
+    - parse: "memory" (python lists, fastest), "stream" (preallocated array) or "memmap" (on disk)
+    - gradient_chunk: time samples per slice of the adjoint product, None for one shot
+    - storage: "memory" (signal store and topology history of the run held, written at the end)
+      or "stream" (written every iteration), for `iterations` iterations of `signals` port signals
+    Returns the plan, the estimates are printed up front.
+    '''
+    budget = budget * 2**30
+    item = np.dtype(dtype).itemsize
+    samples = int(time_end/time_step) + 1
+    pixels = config.pixels
+    field = samples * pixels * 3 * item
+    sample_bytes = pixels * 3 * item
+    # surrogate keeps designs and gradients, its fit builds all pairwise design differences
+    history = surrogate_samples * pixels * 8 * 2 + surrogate_samples**2 * pixels * 8
+    available = budget - BASE_MEMORY - history
+    estimates = {
+        'field': field,
+        'parse memory': field + samples*pixels*LIST_BYTES + field, # E_r held while E_t is parsed
+        'parse stream': 2*field,
+        'gradient one shot': 3*field, # both fields and the product temporary
+        'multi-spec': 12*field if specs else 0, # spectra of both fields and per spec fields
+        'history': history,
+        'storage memory': iterations * (signals*samples*8 + (pixels+7)//8 + 4), # float64 signal values + topology records
+        }
+    if max(estimates['parse memory'], estimates['gradient one shot']) <= available: parse, chunk = "memory", None
+    elif estimates['gradient one shot'] <= available: parse, chunk = "stream", None
+    elif 2*field + sample_bytes <= available:
+        parse, chunk = "stream", max(1, int((available - 2*field) / sample_bytes))
+    else: # fields stay on disk, slices of both plus the product in memory
+        parse, chunk = "memmap", max(1, int(available / (3*sample_bytes)))
+    if chunk is not None: chunk = min(chunk, samples)
+    if parse == "memmap": peak = 3 * (chunk or samples) * sample_bytes
+    elif chunk is None: peak = max(estimates[f'parse {parse}'], estimates['gradient one shot'])
+    else: peak = 2*field + chunk*sample_bytes
+    peak += BASE_MEMORY + history + estimates['multi-spec']
+    # history is held only if it fits next to the iteration peak, otherwise it is written as it comes
+    storage = "memory" if peak + estimates['storage memory'] <= budget else "stream"
+    if storage == "memory": peak += estimates['storage memory']
+    fits = peak <= budget
+    print(f"Memory plan for {pixels} pixels x {samples} samples ({np.dtype(dtype).name}), budget {budget/2**30:.2f} GB:")
+    for name, value in estimates.items(): print(f"  {name:18} {value/2**20:10.1f} MB")
+    print(f"  parse = {parse}, gradient chunk = {chunk or 'one shot'}, storage = {storage}, estimated peak {peak/2**20:.1f} MB")
+    if specs: print("  multi-spec spectra are always held in memory")
+    if not fits: print("  WARNING: estimated peak exceeds the budget even with the leanest modes")
+    return {'parse': parse, 'gradient_chunk': chunk, 'storage': storage, 'peak': peak, 'fits': fits, 'estimates': estimates}
+
+def write_signal_file(path, signal):
+    # [(time, value),...] in the format CST imports as excitation
+    file = open(path, "w")
+    file.write("#\n#'Time / ns'	'default [Real Part]'\n#---------------------------------\n") # IDK why but don't change a word
+    for row in signal:
+        file.write(f"{row[0]} {row[1]}\n")
+    file.close()
+
+def received_power(powerPath, excitation_power):
+    # received power of a signal file without the time reversal, same integration as Optimizer.power_time_reverse
+    signal = np.loadtxt(powerPath, skiprows=3)
+    dt = np.diff(np.concatenate([[0.0], signal[:, 0]]))
+    return np.sum(np.abs(signal[:, 1]) * dt) / excitation_power
+
+def append_topology(path, iteration, topology):
+    # binarized iteration as a fixed size record: int32 iteration + packed pixels of the solved
+    # half (Optimizer.solved_topology), so mirror-equivalent iterations have identical records
+    with open(path, "ab") as file:
+        file.write(np.int32(iteration).tobytes() + topology.bits)
+
+signal_lock = threading.Lock() # concurrent controllers (multi-incidence) share the store
+_signal_store = None
+
+def signal_store(folder="results\\signals"):
+    # one store per process, reloaded only if cwd moved (sweep workers) or clean_results removed it
+    global _signal_store
+    if _signal_store is None or _signal_store.path != os.path.abspath(folder) or not os.path.isdir(folder):
+        if _signal_store is not None and os.path.isdir(_signal_store.path): _signal_store.flush()
+        _signal_store = SignalStore(folder)
+    return _signal_store
+
+def record_signal(name, signal, iteration=None, enabled=True):
+    # Append port signal [(time, signal_value),...] to the signal store, under the running
+    # optimizer iteration unless given; enabled is the calling controller's record_signals
+    if not enabled: return
+    with signal_lock: signal_store().append(name, signal, iteration)
+
+class SignalStore:
+    '''
+    Port signal logs (Tx_input_signal, Tx_reflected_signal, Rx_signal), one compressed chunk
+    per signal and iteration, time axes stored once and shared by every chunk sampled on them:
+    - index.csv: signal, iteration, chunk file, time axis number, samples
+    - time{k}.npy: time axis k
+    - {signal}_{entry}.npz: signal values, entry = running number in the index
+    Iterations are the optimizer's (set in iteration by gradient_ascent), -1 for solves outside
+    an optimization, so resumed runs keep their numbering. mode "stream" writes every append,
+    "memory" (Optimizer.storage_mode, see plan_memory) holds chunks and index rows until flush.
+    '''
+    def __init__(self, folder="results\\signals", mode="stream"):
+        self.folder = folder
+        self.path = os.path.abspath(folder)
+        self.iteration = None # running optimizer iteration
+        self.mode = mode
+        self.held = {} # {chunk: values} not yet written (memory mode)
+        self.held_rows = []
+        os.makedirs(folder, exist_ok=True)
+        self.index = [] # [(signal, iteration, chunk, axis, samples),...]
+        index_path = os.path.join(folder, "index.csv")
+        if os.path.exists(index_path):
+            with open(index_path, newline='') as csvfile:
+                for row in csv.reader(csvfile):
+                    self.index.append((row[0], int(row[1]), row[2], int(row[3]), int(row[4])))
+        self.axes = []
+        while os.path.exists(os.path.join(folder, f"time{len(self.axes)}.npy")):
+            self.axes.append(np.load(os.path.join(folder, f"time{len(self.axes)}.npy")))
+
+    def append(self, name, signal, iteration=None):
+        signal = np.array(signal, float)
+        time_axis, values = signal[:, 0], signal[:, 1]
+        # Reuse a stored time axis if this signal was sampled on it
+        for axis, stored in enumerate(self.axes):
+            if len(stored) == len(time_axis) and np.allclose(stored, time_axis): break
+        else:
+            axis = len(self.axes)
+            np.save(os.path.join(self.folder, f"time{axis}.npy"), time_axis)
+            self.axes.append(time_axis)
+        if iteration is None: iteration = -1 if self.iteration is None else self.iteration
+        chunk = f"{name}_{len(self.index):05d}.npz" # unique even if an iteration is solved twice
+        row = (name, iteration, chunk, axis, len(values))
+        self.index.append(row)
+        if self.mode == "memory":
+            self.held[chunk] = values
+            self.held_rows.append(row)
+        else: self.write([row], {chunk: values})
+
+    def write(self, rows, values):
+        for chunk, chunk_values in values.items(): np.savez_compressed(os.path.join(self.path, chunk), values=chunk_values)
+        with open(os.path.join(self.path, "index.csv"), 'a', newline='') as csvfile:
+            csv.writer(csvfile).writerows(rows)
+
+    def flush(self):
+        # write what memory mode held
+        if self.held_rows: self.write(self.held_rows, self.held)
+        self.held, self.held_rows = {}, []
+
+    def set_mode(self, mode):
+        self.flush()
+        self.mode = mode
+
+    def iterations(self, name):
+        return [entry[1] for entry in self.index if entry[0] == name]
+
+    def read(self, name, start=0, stop=None):
+        '''
+        Signal of iterations start <= i < stop as (iterations, time, values[iteration, sample]).
+        Iterations sampled on shorter time axes are padded with nan.
+        '''
+        entries = [e for e in self.index if e[0] == name and e[1] >= start and (stop is None or e[1] < stop)]
+        entries.sort(key=lambda e: e[1])
+        if not entries: return np.array([], int), np.array([]), np.zeros((0, 0))
+        longest = max(entries, key=lambda e: e[4])
+        values = np.full((len(entries), longest[4]), np.nan)
+        for row, entry in enumerate(entries):
+            if entry[2] in self.held:
+                values[row, :entry[4]] = self.held[entry[2]]
+                continue
+            with np.load(os.path.join(self.folder, entry[2])) as chunk:
+                values[row, :entry[4]] = chunk['values']
+        return np.array([e[1] for e in entries]), self.axes[longest[3]], values
+
+    def energy(self, name, start=0, stop=None):
+        # time integral of signal^2 per iteration
+        iterations, time_axis, values = self.read(name, start, stop)
+        return iterations, np.trapz(np.nan_to_num(values)**2, time_axis, axis=1)
+
+
 # Excitation signal generator
 class Excitation_Generator:
     def __init__(self, amplitudes=[1, 1], frequencies=[1.5, 2.4], ratio_bw=[0.18, 0.1]):
@@ -841,15 +1979,16 @@ class Excitation_Generator:
         self.power = 0
         self.spec_dic = None
 
-    def generate(self):
+    def generate(self, max_freq=None, min_time_end=0, excitePath="txtf\\excitation.txt"):
         print("customizing specification")
         '''
         - amplitudes: [Amplitudes] for each frequency component
         - frequecies: Multiple [frequencies] in GHz [2.4, 3.6, 5.1]
         - ratio_bw: Bandwidth-to-frequency [ratios] [0.1, 0.02, 0.5]
         Time unit in nanoseconds (ns).
+        max_freq and min_time_end let a broadband pulse share timing with stricter specs.
         '''
-        max_freq = max(self.frequencies)
+        if max_freq is None: max_freq = max(self.frequencies)
         ## Make sure time step has no more than n digits, e.g. resolution=0.01 ns
         if max_freq < 2.5: self.time_step = np.around(1/(4 * max_freq), 1)
         elif max_freq < 25: self.time_step = np.around(1/(4 * max_freq), 2)
@@ -864,7 +2003,7 @@ class Excitation_Generator:
         self.time_end = 8 * max_sigma  # Duration of the pulse (6 sigma captures ~99.7% of energy)
         self.time_shift = self.time_end/2
         self.time_end = 10*self.time_end # Need longer time interval for time reverse in adjoint method
-        self.time_end = int(self.time_end) 
+        self.time_end = max(int(self.time_end), min_time_end)
         # Time array shifted to start from 0 to self.time_end in nanoseconds (ns)
         self.t = np.linspace(0, self.time_end, int(self.time_end/(self.time_step/self.resolution))+1)
         # Generate the superposition of Gaussian sine pulses with adjustable bandwidth ratios and amplitudes
@@ -873,7 +2012,7 @@ class Excitation_Generator:
         self.signal = self.signal/np.max(self.signal)
 
         ## Write excitation file
-        self.excitePath = "txtf\excitation.txt"
+        self.excitePath = excitePath
         os.makedirs(os.path.dirname(self.excitePath), exist_ok=True)
         file = open(self.excitePath, "w")
         file.write("#\n#'Time / ns'	'default [Real Part]'\n#---------------------------------\n") # IDK why but don't change a word
@@ -882,6 +2021,7 @@ class Excitation_Generator:
         file.close()
 
         ## Calculate total power the signal carries
+        self.power = 0
         last_time = 0.0
         for index, current_time in enumerate(self.t):
             current_value = self.signal[index]
@@ -894,7 +2034,24 @@ class Excitation_Generator:
             "time_end" : self.time_end,
             "time_step" : self.time_step,
             "excitePath" : self.excitePath,
-            "power" : self.power}
+            "power" : self.power,
+            "amplitudes" : list(self.amplitudes),
+            "frequencies" : list(self.frequencies),
+            "ratio_bw" : list(self.ratio_bw)}
+
+    def generate_broadband(self, generators):
+        '''
+        Single Gaussian pulse covering the bands of all (generated) generators, with time step
+        and duration taken from the most demanding one so every spec can be recovered from it.
+        '''
+        low = min(f*(1-bw) for g in generators for f, bw in zip(g.frequencies, g.ratio_bw))
+        high = max(f*(1+bw) for g in generators for f, bw in zip(g.frequencies, g.ratio_bw))
+        self.amplitudes = [1]
+        self.frequencies = [(low+high)/2]
+        self.ratio_bw = [(high-low)/(high+low)] # spectral sigma = half the covered band
+        max_freq = max(max(g.frequencies) for g in generators)
+        min_time_end = max(g.time_end for g in generators)
+        self.generate(max_freq, min_time_end, "txtf\\broadband_excitation.txt")
 
     def gaussian_sine_pulse_multi(self):
         """
@@ -941,12 +2098,13 @@ class Excitation_Generator:
 
 # results plotting functions
 class Plotter():
-    def __init__(self):
-        self.Ld = L
-        self.Wd = W
-        self.d = D
-        self.nx = NX
-        self.ny = NY
+    def __init__(self, config=None):
+        self.config = DEFAULT_CONFIG if config is None else config
+        self.Ld = self.config.L
+        self.Wd = self.config.W
+        self.d = self.config.D
+        self.nx = self.config.nx
+        self.ny = self.config.ny
         self.results_history_path = {
             'cond':"results\\cond_smoothed_history.txt", 
             'primal':"results\\primal_history.txt",
@@ -1029,8 +2187,15 @@ class Plotter():
                 self.plot_distribution(path, true_position, start=index/batch, end=(index+1)/batch)
                 plt.show()
 
+    def render_all_results(self, processes=None, results_dirs=("results",)):
+        # headless alternative to plot_all_results: images, overviews and animation under results/render
+        import render
+        render.render(list(results_dirs), processes=processes, shape=(self.nx, self.ny))
+
 # Some interesting initial antenna generator
-def generate_shape(shape):
+def generate_shape(shape, config=None):
+    if config is None: config = DEFAULT_CONFIG
+    NX, NY = config.nx, config.ny
     array = np.zeros((NX, NY), dtype=np.int32)
     if shape == 'circle':
         print("generating circle")
@@ -1050,7 +2215,9 @@ def generate_shape(shape):
         array = np.array(array)
     return array
 
-def generate_alphabet(letter, font_size=8):
+def generate_alphabet(letter, font_size=8, config=None):
+    if config is None: config = DEFAULT_CONFIG
+    NX, NY = config.nx, config.ny
     print(f"generating letter {letter}")
     # Create a blank image with a white background
     img = Image.new('L', (NX, NY), 0)  # 'L' mode for grayscale, initialized with black (0)
@@ -0,0 +1,56 @@
+import os
+import time
+import tempfile
+import numpy as np
+import Antenna_Design as ad
+
+
+'''
+Compare float32 and float64 field pipelines on synthetic fields written in the CST ASCII
+export format: parse time, field memory, gradient reduction time and gradient accuracy.
+'''
+
+def write_E_file(path, E, config):
+    # same layout read_E_file expects: two title lines, "Sample" line before every time sample
+    centers = config.pixel_centers
+    with open(path, "w") as file:
+        file.write("x [mm] y [mm] z [mm] ExRe ExIm EyRe\n")
+        file.write("-------------------------------------\n")
+        for t, sample in enumerate(E):
+            file.write(f"Sample {t}\n")
+            for (x, y), (ex, ey, ez) in zip(centers, sample):
+                file.write(f"{x} {y} 0.035 {ex:.6e} {ey:.6e} {ez:.6e}\n")
+        file.write("Sample end\n")
+
+def gradient(E_received, E_excited):
+    return np.sum(np.flip(E_received,0) * E_excited, axis=(0,2), dtype=np.float64)
+
+def benchmark(samples=350, config=ad.DEFAULT_CONFIG, repeat=5):
+    rng = np.random.default_rng(0)
+    E_r = rng.standard_normal((samples, config.pixels, 3))
+    E_t = rng.standard_normal((samples, config.pixels, 3))
+    folder = tempfile.mkdtemp()
+    paths = [os.path.join(folder, "E_received.txt"), os.path.join(folder, "E_excited.txt")]
+    write_E_file(paths[0], E_r, config)
+    write_E_file(paths[1], E_t, config)
+    results = {}
+    for precision in ("float64", "float32"):
+        start = time.time()
+        fields = [ad.read_E_file(path, dtype=np.dtype(precision)) for path in paths]
+        parse = time.time() - start
+        start = time.time()
+        for _ in range(repeat): grad = gradient(*fields)
+        reduction = (time.time() - start) / repeat
+        results[precision] = (parse, fields[0].nbytes + fields[1].nbytes, reduction, grad)
+    reference = results["float64"][3]
+    print(f"{config.pixels} pixels x {samples} samples")
+    print("precision  parse [s]  field memory [MB]  gradient [ms]  max relative error")
+    for precision, (parse, nbytes, reduction, grad) in results.items():
+        error = np.max(np.abs(grad - reference)) / np.max(np.abs(reference))
+        print(f"{precision:9}  {parse:9.3f}  {nbytes/2**20:17.2f}  {reduction*1e3:13.3f}  {error:.2e}")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark(config=ad.DesignConfig(D=1.5))
@@ -0,0 +1,245 @@
+import os
+import time
+import argparse
+import numpy as np
+import Antenna_Design as ad
+
+
+'''
+Stand-in solver for runs without CST: a 2D FDTD (Ex, Ey, Hz) of the patch layer. Rx is a
+uniform in-plane plane wave drive received by a lumped load at the feed, Tx drives the feed
+with the time reversed port signal; fields are sampled at the pixel centers every time_step,
+so received power and adjoint gradient come out exactly as in Optimizer.calculate_gradient
+(power_time_reverse integration, adjoint_gradient product).
+    solver = FDTD()
+    power, grad = solver.evaluate(cond, excitation, excitation_power)
+FDTDController wraps it behind the Controller interface:
+    topop = FDTDController()
+    optimizer = ad.Optimizer(topop, topop)
+One topology per time loop: a leading batch dimension measured 8.07 topologies/s at B=1 and
+8.52 at B=8 (1.06x), the step cost grows linearly with B, so it was dropped. Parallel
+screening and sweeps run several controllers instead (multistart.py slots, sweep.py slots).
+It's a qualitative model (no substrate stack, ground or oblique incidence) for screening,
+sweeps and optimizer benchmarking, not a substitute for the CST solve.
+'''
+
+C0 = 299.792458 # mm/ns
+EPS0 = 8.854187817e-12 # F/m
+
+def default_excitation(time_end):
+    # gaussian modulated sine covering 1~3 GHz, stands in for CST's default excitation
+    t = np.linspace(0, time_end, 2001)
+    return np.stack([t, np.exp(-((t-1.2)/0.4)**2) * np.sin(2*np.pi*2*(t-1.2))], axis=1)
+
+
+class FDTD:
+    def __init__(self, config=None, sub=2, pad=6, absorber=8, eps_r=2.65, courant=0.9, load=50, dtype=np.float64):
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        self.sub = sub # FDTD cells per pixel side
+        self.pad = pad # free cells between design region and absorber
+        self.absorber = absorber # graded loss cells at the border
+        self.eps_r = eps_r # effective permittivity of the layer (FR-4 below, air above)
+        self.courant = courant # fraction of the 2D stability limit
+        self.load = load # ohm, lumped port load
+        self.dtype = np.dtype(dtype) # sampled field precision, the time loop runs in float64
+
+    def grid(self, time_step):
+        # cell size, time step (an integer number per time_step) and the static maps
+        c = self.config
+        dx = c.D / self.sub
+        border = self.pad + self.absorber
+        Nx, Ny = c.nx*self.sub + 2*border, c.ny*self.sub + 2*border
+        steps = int(np.ceil(time_step / (self.courant/np.sqrt(2) * dx/C0)))
+        dt = time_step / steps
+        # graded (cubic) normalized loss in the absorber, cells and both edge families
+        def profile(n):
+            distance = np.maximum(self.absorber - np.minimum(np.arange(n) + 0.5, n - np.arange(n) - 0.5), 0)
+            return 0.8 * (distance/self.absorber)**3
+        loss = np.maximum(profile(Nx)[None, :], profile(Ny)[:, None])
+        feed = (border + int((c.FEEDY + c.W/2) // dx), border + int((c.FEEDX + c.L/2) // dx)) # Ex edge (row, column)
+        inner = loss == 0 # plane wave drive region
+        return {'dx': dx, 'dt': dt, 'steps': steps, 'border': border, 'shape': (Ny, Nx),
+                'loss': loss, 'feed': feed, 'inner': inner, 'S': C0*dt/dx}
+
+    def coefficients(self, cond, g):
+        # semi-implicit lossy update coefficients of Ex [Ny+1, Nx] and Ey [Ny, Nx+1]
+        c, b = self.config, g['border']
+        Ny, Nx = g['shape']
+        sigma = np.zeros((Ny, Nx))
+        pixels = np.asarray(cond, float).reshape(c.ny, c.nx) # index_map order, x fastest
+        sigma[b:Ny-b, b:Nx-b] = np.repeat(np.repeat(pixels, self.sub, axis=0), self.sub, axis=1)
+        a = sigma * g['dt']*1e-9 / (2*EPS0*self.eps_r) + g['loss']
+        a_ex = np.pad(a, ((1, 1), (0, 0)))
+        a_ex = (a_ex[:-1] + a_ex[1:]) / 2
+        a_ey = np.pad(a, ((0, 0), (1, 1)))
+        a_ey = (a_ey[:, :-1] + a_ey[:, 1:]) / 2
+        # lumped load across the feed edge, 1/(R dx) with unit depth
+        a_ex[g['feed']] += g['dt']*1e-9 / (self.load * g['dx']*1e-3 * 2*EPS0*self.eps_r)
+        return {'ca_x': (1-a_ex)/(1+a_ex), 'cb_x': 1/(1+a_ex), 'ca_y': (1-a_ey)/(1+a_ey), 'cb_y': 1/(1+a_ey),
+                'da': (1-g['loss'])/(1+g['loss']), 'db': 1/(1+g['loss'])}
+
+    def sample_fields(self, Ex, Ey, g):
+        # Ex, Ey averaged onto cell centers and over the cells of every pixel -> [pixels, 3]
+        c, b, s = self.config, g['border'], self.sub
+        Ny, Nx = g['shape']
+        ex = (Ex[:-1] + Ex[1:])[b:Ny-b, b:Nx-b] / 2
+        ey = (Ey[:, :-1] + Ey[:, 1:])[b:Ny-b, b:Nx-b] / 2
+        out = np.zeros((c.pixels, 3), self.dtype)
+        out[:, 0] = ex.reshape(c.ny, s, c.nx, s).mean(axis=(1, 3)).ravel()
+        out[:, 1] = ey.reshape(c.ny, s, c.nx, s).mean(axis=(1, 3)).ravel()
+        return out
+
+    def run(self, cond, time_step, time_end, plane=None, feed=None, e_vector=(1, 0)):
+        '''
+        One time loop. plane: drive waveform at every FDTD step [steps+1], feed: feed waveform
+        [steps+1]. Returns the port signal [samples] and the pixel fields [samples, pixels, 3]
+        sampled every time_step.
+        '''
+        g = self.grid(time_step)
+        k = self.coefficients(cond, g)
+        Ny, Nx = g['shape']
+        samples = int(time_end/time_step)
+        Ex, Ey, Hz = np.zeros((Ny+1, Nx)), np.zeros((Ny, Nx+1)), np.zeros((Ny, Nx))
+        S = g['S']
+        cb_x, cb_y = k['cb_x']*S/self.eps_r, k['cb_y']*S/self.eps_r
+        # plane wave drive: impressed current so the free field follows the waveform, none in metal
+        drive_x = k['cb_x'][:-1] * g['inner'] * e_vector[0]
+        drive_y = k['cb_y'][:, :-1] * g['inner'] * e_vector[1]
+        fy, fx = g['feed']
+        feed_cb = k['cb_x'][fy, fx]
+        port = np.zeros(samples)
+        fields = np.zeros((samples, self.config.pixels, 3), self.dtype)
+        for n in range(samples*g['steps']):
+            if n % g['steps'] == 0:
+                sample = n // g['steps']
+                port[sample] = Ex[fy, fx]
+                fields[sample] = self.sample_fields(Ex, Ey, g)
+            Hz *= k['da']
+            Hz -= k['db']*S * ((Ey[:, 1:] - Ey[:, :-1]) - (Ex[1:] - Ex[:-1]))
+            Ex[1:-1] *= k['ca_x'][1:-1]
+            Ex[1:-1] += cb_x[1:-1] * (Hz[1:] - Hz[:-1])
+            Ey[:, 1:-1] *= k['ca_y'][:, 1:-1]
+            Ey[:, 1:-1] -= cb_y[:, 1:-1] * (Hz[:, 1:] - Hz[:, :-1])
+            if plane is not None:
+                change = plane[n+1] - plane[n]
+                if e_vector[0]: Ex[:-1] += drive_x * change
+                if e_vector[1]: Ey[:, :-1] += drive_y * change
+            if feed is not None: Ex[fy, fx] += feed_cb * (feed[n+1] - feed[n])
+        return port, fields
+
+    def step_waveform(self, signal, time_step, time_end):
+        # [(time, value),...] at the FDTD step times
+        g = self.grid(time_step)
+        t = np.arange(int(time_end/time_step)*g['steps'] + 1) * g['dt']
+        signal = np.asarray(signal, float)
+        return np.interp(t, signal[:, 0], signal[:, 1], left=0, right=0)
+
+    def resample(self, values, time_step):
+        # [samples] sampled every time_step -> [steps+1] at the FDTD step times (linear)
+        steps = self.grid(time_step)['steps']
+        n = np.arange(len(values)*steps + 1)
+        k, frac = n // steps, (n % steps) / steps
+        values = np.pad(values, (0, 2)) # zero after the last sample
+        return values[k]*(1-frac) + values[k+1]*frac
+
+    def received_power(self, port, time_step, excitation_power=1):
+        # same integration as Optimizer.power_time_reverse, the first sample sits at t=0
+        dt = np.full(len(port), time_step)
+        dt[0] = 0
+        return np.sum(np.abs(port)*dt) / excitation_power
+
+    def evaluate(self, cond, excitation, excitation_power=1, time_step=None, time_end=None, gradient=True, e_vector=(1, 0)):
+        '''
+        Received power and adjoint gradient [pixels] of one distribution: Rx loop, then Tx loop
+        fed with the time reversed port signal. gradient=False skips Tx (screening).
+        '''
+        time_step = self.config.TSTEP if time_step is None else time_step
+        time_end = self.config.TEND if time_end is None else time_end
+        port, E_received = self.run(cond, time_step, time_end, plane=self.step_waveform(excitation, time_step, time_end), e_vector=e_vector)
+        power = self.received_power(port, time_step, excitation_power)
+        if not gradient: return power, None
+        _, E_excited = self.run(cond, time_step, time_end, feed=self.resample(port[::-1], time_step))
+        # adjoint_gradient, float64 accumulator
+        grad = np.sum(E_received[::-1] * E_excited, axis=(0, 2), dtype=np.float64)
+        return power, grad
+
+
+class FDTDController(ad.StandInController):
+    '''
+    Stands in for Controller in Optimizer, every solve is one FDTD time loop.
+    '''
+    def __init__(self, config=None, **options):
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        self.solver = FDTD(self.config, **options)
+        self.time_step = self.config.TSTEP
+        self.time_end = self.config.TEND
+        self.incidence = ad.INCIDENCE
+        self.tag = "" # file and signal name suffix (multi-incidence controllers)
+        self.cond = np.zeros(self.config.pixels)
+        self.last_signals = {}
+
+    def excitation(self, excitePath):
+        return np.loadtxt(excitePath, skiprows=3) if excitePath else default_excitation(self.time_end)
+
+    def times(self):
+        return np.arange(int(self.time_end/self.time_step)) * self.time_step
+
+    # Controller interface used by Optimizer----------------------------------------------------
+    def xz_symmetric_boundary(self): pass # the whole layer is solved, both halves count
+
+    def update_distribution(self, cond, pixels=None):
+        self.cond = np.array(cond, float)
+
+    def set_fidelity(self, name, settings):
+        # mesh density only: FDTD cells per pixel from the steps per wavelength (10 -> 1, 20 -> 2)
+        self.solver.sub = max(1, int(round(settings['steps_per_wave']/10)))
+        print(f"Fidelity {name} set, {self.solver.sub} cells per pixel")
+
+    def plane_wave_excitation(self, excitePath=None):
+        start = time.time()
+        waveform = self.solver.step_waveform(self.excitation(excitePath), self.time_step, self.time_end)
+        port, E = self.solver.run(self.cond, self.time_step, self.time_end, plane=waveform, e_vector=self.incidence[1][:2])
+        E_Path = f"txtf\\E_received{self.tag}.npy"
+        np.save(E_Path, E)
+        signal = np.stack([self.times(), port], axis=1)
+        powerPath = f"txtf\\power{self.tag}.txt"
+        ad.write_signal_file(powerPath, signal)
+        self.last_signals = {'Rx_signal': signal}
+        ad.record_signal('Rx_signal' + self.tag, signal, enabled=self.record_signals)
+        print(f"pw: fdtd solved in {time.time()-start:.1f} s")
+        return E_Path, powerPath
+
+    def feed_excitation(self, feedPath):
+        start = time.time()
+        feed = np.loadtxt(feedPath, skiprows=3)
+        waveform = self.solver.step_waveform(feed, self.time_step, self.time_end)
+        port, E = self.solver.run(self.cond, self.time_step, self.time_end, feed=waveform)
+        E_Path = f"txtf\\E_excited{self.tag}.npy"
+        np.save(E_Path, E)
+        self.last_signals = {'Tx_input_signal': feed, 'Tx_reflected_signal': np.stack([self.times(), port], axis=1)}
+        for name, signal in self.last_signals.items(): ad.record_signal(name + self.tag, signal, enabled=self.record_signals)
+        print(f"fe: fdtd solved in {time.time()-start:.1f} s")
+        return E_Path
+
+
+def benchmark(repeat=3, config=ad.DEFAULT_CONFIG, seed=0):
+    # seconds per Rx+Tx evaluation of random topologies
+    rng = np.random.default_rng(seed)
+    solver = FDTD(config)
+    excitation = default_excitation(config.TEND)
+    print(f"{config.pixels} pixels, {solver.sub} cells per pixel")
+    seconds = []
+    for _ in range(repeat):
+        cond = np.where(rng.random(config.pixels) < 0.5, 5.8e7, 0.0)
+        start = time.time()
+        solver.evaluate(cond, excitation)
+        seconds.append(time.time() - start)
+    print(f"{np.mean(seconds):.2f} s per topology ({1/np.mean(seconds):.2f} topologies/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    os.makedirs("txtf", exist_ok=True)
+    benchmark(args.repeat)
@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+from dataclasses import asdict
+import Antenna_Design as ad
+
+
+'''
+Shared-directory job queue for solver farms, no services needed, only a shared filesystem.
+    root/jobs/{id}.npz      job (kind rx/tx, conductivity, excitation, timing, DesignConfig), written atomically
+    root/locks/{id}.lock    claim, created with O_EXCL, mtime is the heartbeat
+    root/results/{id}.npz   E field and port signals
+    root/failed/{id}.json   jobs that ran out of retries
+Solver hosts run a worker daemon:
+    python jobqueue.py --root //share/queue --backend cst
+and the optimizer submits through QueueController, which stands in for Controller:
+    topop = QueueController("//share/queue")
+    optimizer = ad.Optimizer(topop, topop)   # then specification(set_monitor=False)
+A claim whose heartbeat is older than the lease is taken over by another worker; a job is
+given up after max_attempts claims.
+'''
+
+def save_npz(path, **arrays):
+    with open(path, "wb") as file: np.savez(file, **arrays)
+
+def job_config(job):
+    # DesignConfig the job was submitted for (json of its fields)
+    return ad.DesignConfig(**json.loads(str(job['config']))) if 'config' in job else ad.DEFAULT_CONFIG
+
+class JobRejected(ValueError):
+    # job that no retry can solve (e.g. geometry mismatch), failed at once instead of retried
+    pass
+
+def replace_write(path, write):
+    # write to a temporary name and rename, readers never see a half written file
+    temp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    write(temp)
+    os.replace(temp, path)
+
+
+class JobQueue:
+    def __init__(self, root="queue", lease=300, max_attempts=3):
+        self.root = root
+        self.lease = lease # seconds without heartbeat before a claim expires
+        self.max_attempts = max_attempts
+        self.count = 0
+        for folder in ("jobs", "locks", "results", "failed"): os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def path(self, folder, job_id, ext):
+        return os.path.join(self.root, folder, f"{job_id}.{ext}")
+
+    # Submitting side----------------------------------------------------------------------------
+    def submit(self, kind, **arrays):
+        job_id = f"{time.time_ns()}_{socket.gethostname()}_{os.getpid()}_{self.count}"
+        self.count += 1
+        replace_write(self.path("jobs", job_id, "npz"), lambda temp: save_npz(temp, kind=kind, **arrays))
+        return job_id
+
+    def wait(self, job_id, poll=1.0, timeout=None):
+        start = time.time()
+        result_path = self.path("results", job_id, "npz")
+        while True:
+            if os.path.exists(result_path):
+                with np.load(result_path) as result: result = dict(result)
+                os.remove(result_path)
+                return result
+            failed = self.path("failed", job_id, "json")
+            if os.path.exists(failed):
+                with open(failed) as file: raise RuntimeError(f"Job {job_id} failed: {json.load(file)['error']}")
+            if timeout is not None and time.time() - start > timeout: raise TimeoutError(f"Job {job_id} not done in {timeout} s")
+            time.sleep(poll)
+
+    # Worker side--------------------------------------------------------------------------------
+    def read_lock(self, lock):
+        try:
+            with open(lock) as file: return json.load(file)
+        except (OSError, ValueError): return None
+
+    def claim(self, worker):
+        # oldest job whose lock is free or expired, None if there is nothing to do
+        for name in sorted(os.listdir(os.path.join(self.root, "jobs"))):
+            if not name.endswith(".npz"): continue
+            job_id = name[:-4]
+            lock = self.path("locks", job_id, "lock")
+            attempts = 0
+            if os.path.exists(lock):
+                try: age = time.time() - os.path.getmtime(lock)
+                except OSError: continue
+                if age < self.lease: continue # someone is on it
+                previous = self.read_lock(lock)
+                attempts = previous['attempts'] if previous else 0
+                # only one worker wins the rename of an expired lock
+                stale = f"{lock}.{worker}.stale"
+                try: os.rename(lock, stale)
+                except OSError: continue
+                os.remove(stale)
+                print(f"Claim on {job_id} expired after {age:.0f} s")
+            try: fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError: continue
+            with os.fdopen(fd, "w") as file: json.dump({'worker': worker, 'attempts': attempts+1, 'claimed': time.time()}, file)
+            if attempts >= self.max_attempts:
+                self.fail(job_id, f"gave up after {attempts} attempts")
+                continue
+            return job_id
+        return None
+
+    def heartbeat(self, job_id):
+        try: os.utime(self.path("locks", job_id, "lock"))
+        except OSError: pass
+
+    def complete(self, job_id, **arrays):
+        replace_write(self.path("results", job_id, "npz"), lambda temp: save_npz(temp, **arrays))
+        self.release(job_id)
+
+    def fail(self, job_id, error):
+        with open(self.path("failed", job_id, "json"), "w") as file: json.dump({'error': error}, file)
+        self.release(job_id)
+
+    def release(self, job_id):
+        for path in (self.path("jobs", job_id, "npz"), self.path("locks", job_id, "lock")):
+            try: os.remove(path)
+            except OSError: pass
+
+
+class Worker:
+    '''
+    Solver host daemon: claims jobs, solves them with its own project (prepared from a
+    TemplateCache template per design config and timing) or the replay stand-in, writes results back.
+    '''
+    def __init__(self, queue, backend='cst', project="CST_Antennas/worker.cst", replay="replay",
+                 template_folder="CST_Antennas/templates", heartbeat=30, poll=2.0):
+        self.queue = queue
+        self.backend = backend
+        self.project = project
+        self.replay = replay
+        self.template_folder = template_folder
+        self.templates = {} # {DesignConfig: TemplateCache}
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.name = f"{socket.gethostname()}_{os.getpid()}"
+        self.controller = None
+        self.setup = None # (time_step, time_end, symmetric, config) of the open project
+        self.cond = None # distribution currently in the project, only changed pixels are rewritten
+        self.fidelity = "" # fidelity applied to the open project
+        os.makedirs("txtf", exist_ok=True)
+        os.makedirs("results", exist_ok=True)
+
+    def prepare(self, time_step, time_end, symmetric, config):
+        if self.setup == (time_step, time_end, symmetric, config): return
+        if self.backend == 'replay':
+            import replay
+            if self.controller is None or self.controller.config != config: self.controller = replay.ReplayController(self.replay, config=config)
+        else:
+            if self.controller is not None: self.controller.close_project()
+            self.controller = None
+            templates = self.templates.setdefault(config, ad.TemplateCache(self.template_folder, config))
+            self.controller = templates.create(self.project, time_step, time_end, symmetric)
+            self.cond = None
+            self.fidelity = ""
+        self.controller.time_step = time_step
+        self.controller.time_end = time_end
+        self.setup = (time_step, time_end, symmetric, config)
+
+    def solve(self, job):
+        config = job_config(job)
+        if len(job['cond']) != config.pixels:
+            raise JobRejected(f"{len(job['cond'])} pixels for a {config.nx}x{config.ny} design config")
+        self.prepare(float(job['time_step']), float(job['time_end']), bool(job['symmetric']), config)
+        if self.controller.config != config:
+            raise JobRejected(f"project is set up for {self.controller.config}, job needs {config}")
+        fidelity = str(job['fidelity'])
+        if fidelity and fidelity != self.fidelity and hasattr(self.controller, "set_fidelity"):
+            self.controller.set_fidelity(*json.loads(fidelity))
+            self.fidelity = fidelity
+        cond = job['cond']
+        pixels = None if self.cond is None else np.flatnonzero(cond != self.cond)
+        self.controller.update_distribution(cond, pixels)
+        self.cond = cond.copy()
+        if str(job['kind']) == 'rx':
+            if 'incidence' in job: self.controller.incidence = tuple(map(tuple, job['incidence'].tolist()))
+            signalPath = None
+            if job['signal'].size:
+                signalPath = "txtf\\queue_excitation.txt"
+                ad.write_signal_file(signalPath, job['signal'])
+            E_Path, powerPath = self.controller.plane_wave_excitation(signalPath)
+            out = {'power': np.loadtxt(powerPath, skiprows=3)}
+        else:
+            feedPath = "txtf\\queue_feed.txt"
+            ad.write_signal_file(feedPath, job['signal'])
+            E_Path = self.controller.feed_excitation(feedPath)
+            out = {}
+        out['E'] = ad.read_E_file(E_Path, dtype=np.dtype(str(job['dtype'])))
+        for name, signal in self.controller.last_signals.items(): out[f"signal_{name}"] = np.array(signal, float)
+        return out
+
+    def run_job(self, job_id):
+        done = threading.Event()
+        def beat():
+            while not done.wait(self.heartbeat): self.queue.heartbeat(job_id)
+        threading.Thread(target=beat, daemon=True).start()
+        start = time.time()
+        try:
+            with np.load(self.queue.path("jobs", job_id, "npz")) as job: job = dict(job)
+            out = self.solve(job)
+            self.queue.complete(job_id, **out)
+            print(f"{self.name}: {job_id} done in {time.time()-start:.1f} s")
+        except JobRejected as e:
+            print(f"{self.name}: {job_id} rejected: {e}")
+            self.queue.fail(job_id, f"rejected: {e}")
+        except Exception as e:
+            # lock stays until the lease expires, then the job is retried (possibly elsewhere)
+            print(f"{self.name}: {job_id} failed: {e}")
+            self.setup = None # reopen the project before the next job
+        finally: done.set()
+
+    def serve(self, max_jobs=None):
+        print(f"Worker {self.name} polling {self.queue.root}")
+        jobs = 0
+        while max_jobs is None or jobs < max_jobs:
+            job_id = self.queue.claim(self.name)
+            if job_id is None:
+                time.sleep(self.poll)
+                continue
+            self.run_job(job_id)
+            jobs += 1
+
+
+class QueueController(ad.StandInController):
+    '''
+    Stands in for Controller in Optimizer; every solve is a job on the queue. Project setup is
+    a no-op here, workers prepare their projects from templates, so use set_environment=False, specification(set_monitor=False)
+    and gradient_ascent(symmetric=False) (self.symmetric goes to the workers instead).
+    '''
+    def __init__(self, root="queue", config=None, symmetric=True, dtype=np.float64, timeout=None):
+        self.queue = JobQueue(root)
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        self.time_step = self.config.TSTEP
+        self.time_end = self.config.TEND
+        self.symmetric = symmetric
+        self.dtype = np.dtype(dtype) # precision of the returned fields
+        self.timeout = timeout
+        self.cond = None
+        self.fidelity = "" # json of (level, settings) set by Optimizer.select_fidelity
+        self.incidence = ad.INCIDENCE
+        self.tag = "" # local file and signal name suffix (multi-incidence controllers)
+        self.last_signals = {}
+
+    def job(self, kind, signal):
+        return self.queue.submit(kind, cond=np.asarray(self.cond, float), signal=signal,
+                                 time_step=self.time_step, time_end=self.time_end,
+                                 symmetric=self.symmetric, dtype=self.dtype.str, fidelity=self.fidelity,
+                                 incidence=np.array(self.incidence, float), config=json.dumps(asdict(self.config)))
+
+    def result(self, job_id):
+        start = time.time()
+        result = self.queue.wait(job_id, timeout=self.timeout)
+        self.last_signals = {name[len("signal_"):]: value for name, value in result.items() if name.startswith("signal_")}
+        for name, signal in self.last_signals.items(): ad.record_signal(name + self.tag, signal, enabled=self.record_signals)
+        print(f"queue: job {job_id} returned after {time.time()-start:.1f} s")
+        return result
+
+    # Controller interface used by Optimizer----------------------------------------------------
+    def update_distribution(self, cond, pixels=None):
+        self.cond = np.array(cond, float) # jobs carry the full distribution
+
+    def set_fidelity(self, name, settings):
+        self.fidelity = json.dumps([name, settings])
+
+    def plane_wave_excitation(self, excitePath=None):
+        signal = np.loadtxt(excitePath, skiprows=3) if excitePath else np.zeros((0, 2))
+        result = self.result(self.job("rx", signal))
+        E_Path = f"txtf\\E_received{self.tag}.npy"
+        np.save(E_Path, result['E'])
+        powerPath = f"txtf\\power{self.tag}.txt"
+        ad.write_signal_file(powerPath, result['power'])
+        return E_Path, powerPath
+
+    def feed_excitation(self, feedPath):
+        result = self.result(self.job("tx", np.loadtxt(feedPath, skiprows=3)))
+        E_Path = f"txtf\\E_excited{self.tag}.npy"
+        np.save(E_Path, result['E'])
+        return E_Path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default="queue")
+    parser.add_argument("--backend", choices=['cst', 'replay'], default='cst')
+    parser.add_argument("--project", default="CST_Antennas/worker.cst")
+    parser.add_argument("--replay", default="replay")
+    parser.add_argument("--lease", type=float, default=300)
+    args = parser.parse_args()
+    Worker(JobQueue(args.root, lease=args.lease), args.backend, args.project, args.replay).serve()
@@ -32,7 +32,8 @@ if __name__ == "__main__":
     linear_map = False
     filter = False
     Adam = True
-    print(f"alpha={alpha}, linear_map={linear_map}, filter={filter}, Adam={Adam}")
+    active_set = False # freeze pixels stable for optimizer.freeze_k iterations
+    print(f"alpha={alpha}, linear_map={linear_map}, filter={filter}, Adam={Adam}, active_set={active_set}")
 
     # set initial antenna topology
     initial = ad.generate_shape("square")
@@ -49,4 +50,4 @@ if __name__ == "__main__":
     # optimizer.Adam_var_init = adam_var
     # optimizer.power_init = power_init
     if clean_legacy: optimizer.clean_results()
-    optimizer.gradient_ascent(linear_map=linear_map, filter=filter, Adam=Adam, max_iter=36, symmetric=True)
+    optimizer.gradient_ascent(linear_map=linear_map, filter=filter, Adam=Adam, max_iter=36, symmetric=True, active_set=active_set)
@@ -0,0 +1,127 @@
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+'''
+Local HTTP metrics endpoint for a running optimization.
+    optimizer.metrics = MetricsServer(port=8000, name="dual_band")
+GET /metrics -> Prometheus text format, GET /status -> JSON
+'''
+
+def memory_usage():
+    # {'rss_bytes': current resident memory} with psutil, else {'peak_rss_bytes': peak resident
+    # memory since start} from getrusage, {} if neither is available on this platform
+    try:
+        import psutil
+        return {'rss_bytes': psutil.Process().memory_info().rss}
+    except ImportError: pass
+    try: import resource
+    except ImportError: return {}
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'peak_rss_bytes': peak if sys.platform == 'darwin' else peak * 1024} # bytes on macOS, KiB on Linux
+
+
+class MetricsServer:
+    def __init__(self, port=8000, name="optimization", host="127.0.0.1"):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = {'name': name, 'status': 'idle', 'iteration': None, 'iter_init': 0, 'max_iter': None,
+                      'phase': None, 'phase_since': time.time(), 'received_power': None,
+                      'rms_grad': None, 'rms_step': None, 'iteration_seconds': [], 'started': None}
+        self.durations = {} # {phase: [total seconds, count]}
+        self.cache_hits = {} # {cache: {'hit': n, 'miss': n}}
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, kind = server.prometheus(), 'text/plain; version=0.0.4'
+                elif self.path.startswith('/status'):
+                    body, kind = json.dumps(server.status(), indent=1), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): pass # keep the optimizer console readable
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"Metrics at http://{host}:{self.httpd.server_port}/metrics and /status")
+
+    # Updates from Optimizer--------------------------------------------------------------------------
+    def update(self, **values):
+        with self.lock: self.state.update(values)
+
+    def set_phase(self, phase):
+        with self.lock:
+            self.state['phase'] = phase
+            self.state['phase_since'] = time.time()
+
+    def add_duration(self, phase, seconds):
+        with self.lock:
+            total = self.durations.setdefault(phase, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def end_iteration(self, seconds):
+        with self.lock: self.state['iteration_seconds'].append(seconds)
+
+    def set_cache(self, cache, hit, miss):
+        with self.lock: self.cache_hits[cache] = {'hit': hit, 'miss': miss}
+
+    def close(self):
+        self.httpd.shutdown()
+
+    # Views----------------------------------------------------------------------------------------
+    def status(self):
+        with self.lock:
+            state = dict(self.state)
+            seconds = list(state.pop('iteration_seconds'))
+            durations = {phase: {'total': t, 'count': n} for phase, (t, n) in self.durations.items()}
+            caches = {cache: dict(counts) for cache, counts in self.cache_hits.items()}
+        state['phase_seconds'] = time.time() - state['phase_since']
+        state['iterations_done'] = len(seconds)
+        state['mean_iteration_seconds'] = sum(seconds)/len(seconds) if seconds else None
+        state['eta_seconds'] = None
+        if seconds and state['max_iter'] is not None and state['iteration'] is not None:
+            remaining = state['max_iter'] - state['iteration'] - 1
+            state['eta_seconds'] = max(remaining, 0) * state['mean_iteration_seconds']
+        state['phase_durations'] = durations
+        state['cache_hit_rate'] = {cache: c['hit']/(c['hit']+c['miss']) if c['hit']+c['miss'] else None for cache, c in caches.items()}
+        state['memory'] = memory_usage()
+        return state
+
+    def prometheus(self):
+        status = self.status()
+        label = f'run="{self.name}"'
+        lines = []
+        def metric(name, value, kind="gauge", help_text="", labels=label):
+            if value is None: return
+            if help_text: lines.append(f"# HELP topop_{name} {help_text}")
+            lines.append(f"# TYPE topop_{name} {kind}")
+            lines.append(f"topop_{name}{{{labels}}} {float(value)}")
+        metric("iteration", status['iteration'], help_text="current iteration index")
+        metric("max_iter", status['max_iter'])
+        metric("running", status['status'] == 'running')
+        metric("received_power", status['received_power'], help_text="received power of the last solve")
+        metric("rms_grad", status['rms_grad'])
+        metric("rms_step", status['rms_step'])
+        metric("current_phase_seconds", status['phase_seconds'], help_text=f"time spent in current phase {status['phase']}")
+        metric("iteration_seconds_mean", status['mean_iteration_seconds'])
+        metric("eta_seconds", status['eta_seconds'])
+        metric("memory_rss_bytes", status['memory'].get('rss_bytes'), help_text="current resident memory")
+        metric("memory_peak_rss_bytes", status['memory'].get('peak_rss_bytes'), help_text="peak resident memory (psutil not installed)")
+        lines.append("# TYPE topop_phase_seconds_total counter")
+        for phase, d in status['phase_durations'].items():
+            lines.append(f'topop_phase_seconds_total{{{label},phase="{phase}"}} {d["total"]}')
+        lines.append("# TYPE topop_cache_hit_rate gauge")
+        for cache, rate in status['cache_hit_rate'].items():
+            if rate is not None: lines.append(f'topop_cache_hit_rate{{{label},cache="{cache}"}} {rate}')
+        return "\n".join(lines) + "\n"
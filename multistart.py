@@ -0,0 +1,171 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import scipy.ndimage as scimage
+from concurrent.futures import ThreadPoolExecutor
+import Antenna_Design as ad
+
+
+'''
+Multi-start initialization: build a population of initial topologies, screen it with short
+low fidelity Rx-only solves (plane wave excitation and received power, no Tx, no gradient)
+spread over several solver instances, and start the full optimization only from the top-k.
+    starts = MultiStart([ad.TemplateCache().create(f"CST_Antennas/screen{slot}.cst", ...) for slot in range(2)], spec_dic)
+    starts.screen(starts.population())
+    starts.launch(top_k=3, slots=2)   # one sweep run per start, see sweep.py
+    primal = np.load(starts.ranked[0]['path'])   # or start main.py's optimizer from the best one
+Screening solves are kept short by the fidelity level (FIDELITY pulse_widths caps the solver
+duration, the monitor keeps the spec's time_end), skip the E field export and are not recorded
+in the signal store.
+Screening controllers are left at the screening fidelity, so use separate projects for them.
+'''
+
+SHAPES = ('square', 'circle', 'rectangle')
+LETTERS = "AEHLOTUX"
+
+def primal_to_cond(primal, linear_map=False):
+    # same mapping as Optimizer.gradient_ascent
+    primal = np.clip(primal, 0, 1)
+    if linear_map: return primal*5.8e7
+    return 10**(7.76 * primal) - 1
+
+def smooth_field(config, rng, radius, fill):
+    # random blobs: gaussian filtered noise, the top `fill` fraction of pixels set to metal
+    field = scimage.gaussian_filter(rng.standard_normal((config.ny, config.nx)), radius)
+    return (field >= np.quantile(field, 1-fill)).astype(float).ravel()
+
+def candidate_population(config=None, random_fields=16, noisy=1, noise_dB=40, letters=LETTERS, seed=0):
+    '''
+    [(name, primal),...] from generate_shape (full and scaled by 0.5 like main.py), generate_alphabet,
+    add_noise_to_1D variants of those and random smooth fields. Duplicates are dropped.
+    '''
+    config = ad.DEFAULT_CONFIG if config is None else config
+    rng = np.random.default_rng(seed)
+    base = []
+    for shape in SHAPES:
+        primal = ad.generate_shape(shape, config).astype(float).ravel()
+        base += [(shape, primal), (f"{shape}_x0.5", primal*0.5)]
+    for letter in letters:
+        base.append((f"letter_{letter}", ad.generate_alphabet(letter, font_size=max(8, config.nx//2), config=config).astype(float).ravel()))
+    population = list(base)
+    for name, primal in base:
+        for k in range(noisy): population.append((f"{name}+noise{k}", ad.add_noise_to_1D(primal, noise_dB)))
+    for k in range(random_fields):
+        radius = rng.uniform(0.5, 2) * config.nx/16
+        fill = rng.uniform(0.3, 0.7)
+        population.append((f"random{k}_r{radius:.1f}_f{fill:.2f}", smooth_field(config, rng, radius, fill)))
+    unique = {}
+    for name, primal in population:
+        if primal.size != config.pixels or not np.any(primal): continue # empty letters of small fonts
+        unique.setdefault(np.round(primal, 6).tobytes(), (name, primal))
+    print(f"Multi-start population: {len(unique)} candidates ({len(population)-len(unique)} duplicates or empty dropped)")
+    return list(unique.values())
+
+
+class MultiStart:
+    def __init__(self, controllers, spec_dic, config=None, fidelity="low", linear_map=False, out="multistart"):
+        self.controllers = list(controllers) # one screening solver instance per thread
+        self.spec_dic = spec_dic
+        self.config = getattr(self.controllers[0], "config", ad.DEFAULT_CONFIG) if config is None else config
+        self.fidelity = fidelity # FIDELITY level of the screening solves, None keeps the project settings
+        self.linear_map = linear_map
+        self.out = os.path.abspath(out)
+        self.ranked = [] # screening rows, best received power first
+        os.makedirs(os.path.join(self.out, "starts"), exist_ok=True)
+        for slot, controller in enumerate(self.controllers):
+            if len(self.controllers) > 1: controller.tag = f"_m{slot}"
+            controller.time_step = spec_dic["time_step"]
+            controller.time_end = spec_dic["time_end"]
+            controller.record_signals = False # screening solves stay out of the optimizer's signal store
+            controller.export_fields = False # only the received power is read (Controller skips the E field export)
+            if fidelity is not None:
+                if hasattr(controller, "set_fidelity"): controller.set_fidelity(fidelity, ad.FIDELITY[fidelity])
+                else: print("Backend has no fidelity settings, screening at project settings")
+
+    def population(self, **options):
+        return candidate_population(self.config, **options)
+
+    def screen(self, candidates):
+        '''
+        Received power of every (name, primal) candidate from one Rx solve each, candidates spread
+        over the controllers, controllers run concurrently. Ranked rows go to out/screening.csv.
+        '''
+        print(f"Screening {len(candidates)} candidates on {len(self.controllers)} controllers")
+        def solve(slot):
+            controller = self.controllers[slot]
+            rows = []
+            for index in range(slot, len(candidates), len(self.controllers)):
+                name, primal = candidates[index]
+                start = time.time()
+                row = {'name': name, 'received_power': np.nan, 'metal': float(np.mean(primal >= 0.5)), 'seconds': np.nan}
+                try:
+                    controller.update_distribution(primal_to_cond(primal, self.linear_map))
+                    _, powerPath = controller.plane_wave_excitation(self.spec_dic["excitePath"])
+                    row['received_power'] = ad.received_power(powerPath, self.spec_dic["power"])
+                except Exception as e: print(f"Candidate {name} failed: {e}")
+                row['seconds'] = time.time() - start
+                print(f"screen {name}: power = {row['received_power']}, {row['seconds']:.1f} s")
+                rows.append((index, row))
+            return rows
+        start = time.time()
+        rows = [None]*len(candidates)
+        with ThreadPoolExecutor(len(self.controllers)) as pool:
+            for results in pool.map(solve, range(len(self.controllers))):
+                for index, row in results: rows[index] = row
+        for (name, primal), row in zip(candidates, rows):
+            row['path'] = os.path.join(self.out, "starts", f"{name}.npy")
+            np.save(row['path'], primal)
+        # failed candidates (nan) last
+        self.ranked = sorted(rows, key=lambda row: -row['received_power'] if np.isfinite(row['received_power']) else np.inf)
+        with open(os.path.join(self.out, "screening.csv"), 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['rank', 'name', 'received_power', 'metal', 'seconds', 'path'])
+            for rank, row in enumerate(self.ranked):
+                writer.writerow([rank, row['name'], row['received_power'], row['metal'], row['seconds'], row['path']])
+        print(f"Screening done in {time.time()-start:.0f} s, best: " +
+              ", ".join(f"{row['name']} ({row['received_power']:.4g})" for row in self.ranked[:3]))
+        return self.ranked
+
+    def top(self, k=3):
+        # [(name, primal),...] of the k best screened candidates
+        return [(row['name'], np.load(row['path'])) for row in self.ranked[:k] if np.isfinite(row['received_power'])]
+
+    def launch(self, top_k=3, name="multistart", slots=1, **overrides):
+        # full optimization from each of the top_k starts, one sweep run each (sweep.DEFAULT_CONFIG overrides)
+        import sweep
+        configs = [dict(overrides, exp=f"start{rank}_{row['name']}", initial=row['path'], initial_scale=1)
+                   for rank, row in enumerate(self.ranked[:top_k]) if np.isfinite(row['received_power'])]
+        return sweep.run_sweep(configs, name=name, slots=slots)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=['cst', 'replay', 'fdtd'], default='cst')
+    parser.add_argument("--slots", type=int, default=1, help="screening solver instances")
+    parser.add_argument("--random", type=int, default=16, help="random smooth fields in the population")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--replay", default="replay")
+    parser.add_argument("--screen-only", action="store_true")
+    args = parser.parse_args()
+    # Defaults mirror main.py
+    excitation_generator = ad.Excitation_Generator([0.5, 0.5], [1.5, 2.4], [0.13, 0.07])
+    excitation_generator.generate()
+    spec_dic = excitation_generator.spec_dic
+    if args.backend == 'replay':
+        import replay
+        controllers = [replay.ReplayController(args.replay) for slot in range(args.slots)]
+    elif args.backend == 'fdtd':
+        import fdtd
+        controllers = [fdtd.FDTDController() for slot in range(args.slots)]
+    else:
+        templates = ad.TemplateCache()
+        controllers = [templates.create(f"CST_Antennas/screen{slot}.cst", spec_dic["time_step"], spec_dic["time_end"])
+                       for slot in range(args.slots)]
+    starts = MultiStart(controllers, spec_dic)
+    starts.screen(starts.population(random_fields=args.random))
+    if args.backend == 'cst':
+        for controller in controllers: controller.close_project()
+    if not args.screen_only:
+        starts.launch(args.top_k, slots=args.slots, backend=args.backend, replay=args.replay)
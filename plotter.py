@@ -1,9 +1,11 @@
+import sys
 from Antenna_Design import Plotter
 
 
 if __name__ == "__main__":
     plotter = Plotter()
-    plotter.plot_all_results(1, true_position=False)
+    if "--headless" in sys.argv: plotter.render_all_results() # renders to results/render, no window
+    else: plotter.plot_all_results(1, true_position=False)
     
     # f = open("macro.txt")
     # a = f.read()
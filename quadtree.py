@@ -0,0 +1,112 @@
+import numpy as np
+import Antenna_Design as ad
+
+
+class QuadtreeDesign:
+    '''
+    Adaptive cell parameterization of the design region on top of the fine pixel grid.
+    Cells are squares of size fine pixels (powers of two), starting at `coarse`; adapt() splits
+    cells on the metal boundary or with a non-uniform adjoint gradient inside, and merges four
+    siblings whose parent area is uniform and quiet. Fields are still exported on the fine grid;
+    the optimizer steps with the mean of the fine gradient over each cell (project, the cell sum
+    divided by its area so large cells don't take larger steps) and keeps its primal on the fine
+    grid, uniform inside every cell.
+        optimizer.quadtree = QuadtreeDesign(ad.DesignConfig(D=1.5), coarse=8)
+    '''
+    def __init__(self, config=None, coarse=4, min_size=1, max_size=None, split_ratio=0.5, merge_ratio=0.1):
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        nx, ny = self.config.nx, self.config.ny
+        while coarse > 1 and (nx % coarse or ny % coarse): coarse //= 2 # cells must tile the grid
+        if merge_ratio >= split_ratio: raise ValueError("merge_ratio must be below split_ratio (hysteresis)")
+        self.min_size = min_size
+        self.max_size = coarse if max_size is None else max_size
+        self.split_ratio = split_ratio # split when the gradient std inside a cell exceeds this * rms
+        self.merge_ratio = merge_ratio # merge siblings whose gradient std over the parent stays below this * rms
+        self.cells = [(x, y, coarse) for y in range(0, ny, coarse) for x in range(0, nx, coarse)]
+        self.update_map()
+
+    def update_map(self):
+        self.cells.sort(key=lambda cell: (cell[1], cell[0], cell[2]))
+        index_map = self.config.index_map # [yi, xi] -> fine pixel
+        self.pixel_map = np.empty(self.config.pixels, int)
+        for k, (x, y, size) in enumerate(self.cells): self.pixel_map[index_map[y:y+size, x:x+size]] = k
+        self.area = np.bincount(self.pixel_map, minlength=len(self.cells))
+
+    def __len__(self): return len(self.cells)
+
+    # Fine grid <-> cells----------------------------------------------------------------------------
+    def aggregate(self, values):
+        # per cell sum (gradient of a cell value)
+        return np.bincount(self.pixel_map, np.asarray(values, float), minlength=len(self.cells))
+
+    def restrict(self, values):
+        # per cell mean
+        return self.aggregate(values) / self.area
+
+    def expand(self, cell_values):
+        return np.asarray(cell_values)[self.pixel_map]
+
+    def project(self, values):
+        # fine grid values made uniform per cell
+        return self.expand(self.restrict(values))
+
+    def boxes(self):
+        # [xmin, xmax, ymin, ymax] in mm of every cell, same frame as DesignConfig.pixel_boxes
+        c = self.config
+        cells = np.array(self.cells, float)
+        xmin = cells[:, 0]*c.D - c.L/2
+        ymin = cells[:, 1]*c.D - c.W/2
+        return np.stack([xmin, xmin + cells[:, 2]*c.D, ymin, ymin + cells[:, 2]*c.D], axis=1)
+
+    # Refinement-------------------------------------------------------------------------------------
+    def boundary(self, primal):
+        # cells holding a fine pixel whose metal state differs from a neighbour's
+        state = (self.project(primal) >= 0.5).reshape(self.config.ny, self.config.nx)
+        edge = np.zeros_like(state)
+        edge[:, 1:] |= state[:, 1:] != state[:, :-1]
+        edge[:, :-1] |= state[:, 1:] != state[:, :-1]
+        edge[1:, :] |= state[1:, :] != state[:-1, :]
+        edge[:-1, :] |= state[1:, :] != state[:-1, :]
+        return self.aggregate(edge.ravel()) > 0
+
+    def adapt(self, grad, primal):
+        '''
+        Split and merge cells from the fine gradient and primal of the last iteration.
+        Returns True if the cells changed (controllers then need set_cells).
+        '''
+        grad = np.asarray(grad, float)
+        rms = np.sqrt(np.mean(grad**2)) or 1
+        std = np.sqrt(np.maximum(self.restrict(grad**2) - self.restrict(grad)**2, 0))
+        on_boundary = self.boundary(primal)
+        metal = self.restrict(primal) >= 0.5
+        split = [k for k, (_, _, size) in enumerate(self.cells)
+                 if size > self.min_size and (on_boundary[k] or std[k] > self.split_ratio*rms)]
+        # merge four leaf siblings that agree and are quiet; the gradient std is taken over the
+        # parent area, the same statistic a split of the parent would test, so merge_ratio <
+        # split_ratio keeps just split cells from merging straight back
+        position = {cell: k for k, cell in enumerate(self.cells)}
+        index_map = self.config.index_map
+        merged, merge = set(), []
+        for k, (x, y, size) in enumerate(self.cells):
+            parent = 2*size
+            if parent > self.max_size or x % parent or y % parent: continue
+            siblings = [position.get((x+dx, y+dy, size)) for dy in (0, size) for dx in (0, size)]
+            if None in siblings or any(on_boundary[s] or s in split for s in siblings): continue
+            if len({metal[s] for s in siblings}) > 1: continue
+            if np.std(grad[index_map[y:y+parent, x:x+parent]]) >= self.merge_ratio*rms: continue
+            merge.append((x, y, parent))
+            merged.update(siblings)
+        if not split and not merge: return False
+        cells = [cell for k, cell in enumerate(self.cells) if k not in merged and k not in split]
+        for k in split:
+            x, y, size = self.cells[k]
+            half = size // 2
+            cells += [(x+dx, y+dy, half) for dy in (0, half) for dx in (0, half)]
+        self.cells = cells + merge
+        self.update_map()
+        print(f"Quadtree: {len(split)} cells split, {len(merge)} merged, {len(self.cells)} cells")
+        return True
+
+    def describe(self):
+        sizes, counts = np.unique([size for _, _, size in self.cells], return_counts=True)
+        return ", ".join(f"{count}x{size}" for size, count in zip(sizes, counts))
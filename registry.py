@@ -0,0 +1,145 @@
+import os
+import csv
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import subprocess
+
+
+'''
+Experiment registry, a local SQLite index of every optimization run:
+configuration, spec, git revision, per-iteration metrics and artifact locations.
+    optimizer.registry = Registry()   # experiments/registry.sqlite
+    optimizer.exp = "dual_band"
+    ...
+    Registry().best_per_spec()
+    Registry().slower_than(3600)
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    exp TEXT, status TEXT, host TEXT, git_rev TEXT,
+    config TEXT, spec TEXT, spec_key TEXT, results_dir TEXT,
+    started REAL, finished REAL, runtime REAL,
+    iterations INTEGER, final_power REAL, best_power REAL);
+CREATE TABLE IF NOT EXISTS iterations (
+    run_id INTEGER, iteration INTEGER, received_power REAL,
+    rms_grad REAL, rms_step REAL, seconds REAL,
+    PRIMARY KEY (run_id, iteration));
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER, kind TEXT, path TEXT);
+CREATE INDEX IF NOT EXISTS runs_exp ON runs (exp);
+CREATE INDEX IF NOT EXISTS runs_spec ON runs (spec_key, best_power);
+CREATE INDEX IF NOT EXISTS runs_runtime ON runs (runtime);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id);
+'''
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return rev.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+def spec_key(spec):
+    # runs with the same spec (frequencies, bandwidths, timing...) share a key
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+class Registry:
+    def __init__(self, path="experiments/registry.sqlite"):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # one connection per process, sweep workers open their own
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    # Recording--------------------------------------------------------------------------------------
+    def start_run(self, exp, config, spec, results_dir="results"):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (exp, status, host, git_rev, config, spec, spec_key, results_dir, started, iterations) "
+                "VALUES (?, 'running', ?, ?, ?, ?, ?, ?, ?, 0)",
+                (exp, socket.gethostname(), git_revision(), json.dumps(config, default=str),
+                 json.dumps(spec, default=str), spec_key(spec), os.path.abspath(results_dir), time.time()))
+        print(f"Registry: run {cursor.lastrowid} ({exp}) started")
+        return cursor.lastrowid
+
+    def log_iteration(self, run_id, iteration, received_power, rms_grad=None, rms_step=None, seconds=None):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO iterations VALUES (?, ?, ?, ?, ?, ?)",
+                            (run_id, iteration, received_power, rms_grad, rms_step, seconds))
+
+    def add_artifact(self, run_id, kind, path):
+        with self.db:
+            self.db.execute("INSERT INTO artifacts VALUES (?, ?, ?)", (run_id, kind, os.path.abspath(path)))
+
+    def finish_run(self, run_id, status="done"):
+        with self.db:
+            summary = self.db.execute(
+                "SELECT COUNT(*), MAX(received_power) FROM iterations WHERE run_id = ?", (run_id,)).fetchone()
+            final = self.db.execute(
+                "SELECT received_power FROM iterations WHERE run_id = ? ORDER BY iteration DESC LIMIT 1", (run_id,)).fetchone()
+            now = time.time()
+            self.db.execute(
+                "UPDATE runs SET status = ?, finished = ?, runtime = ? - started, iterations = ?, best_power = ?, final_power = ? WHERE id = ?",
+                (status, now, now, summary[0], summary[1], final[0] if final else None, run_id))
+        print(f"Registry: run {run_id} {status}")
+
+    def import_results(self, results_dir, exp=None, config=None, spec=None):
+        # back-fill a finished results folder (received power per iteration from total_power.csv)
+        run_id = self.start_run(exp or os.path.basename(os.path.dirname(os.path.abspath(results_dir))),
+                                config or {}, spec or {}, results_dir)
+        path = os.path.join(results_dir, "total_power.csv")
+        if os.path.exists(path):
+            with open(path, newline='') as csvfile:
+                for iteration, row in enumerate(row for row in csv.reader(csvfile) if row):
+                    self.log_iteration(run_id, iteration, float(row[0]))
+        for name in os.listdir(results_dir):
+            self.add_artifact(run_id, os.path.splitext(name)[0], os.path.join(results_dir, name))
+        self.finish_run(run_id, "imported")
+        return run_id
+
+    # Queries----------------------------------------------------------------------------------------
+    def query(self, sql, parameters=()):
+        return [dict(row) for row in self.db.execute(sql, parameters)]
+
+    def runs(self, exp=None, status=None):
+        sql, parameters = "SELECT * FROM runs WHERE 1", []
+        if exp is not None:
+            sql += " AND exp = ?"
+            parameters.append(exp)
+        if status is not None:
+            sql += " AND status = ?"
+            parameters.append(status)
+        return self.query(sql + " ORDER BY id", parameters)
+
+    def best_per_spec(self):
+        # best run of every spec
+        return self.query(
+            "SELECT r.* FROM runs r JOIN (SELECT spec_key, MAX(best_power) AS best FROM runs GROUP BY spec_key) b "
+            "ON r.spec_key = b.spec_key AND r.best_power = b.best ORDER BY r.best_power DESC")
+
+    def slower_than(self, seconds):
+        return self.query("SELECT * FROM runs WHERE runtime > ? ORDER BY runtime DESC", (seconds,))
+
+    def iterations(self, run_id):
+        return self.query("SELECT * FROM iterations WHERE run_id = ? ORDER BY iteration", (run_id,))
+
+    def artifacts(self, run_id, kind=None):
+        if kind is None: return self.query("SELECT * FROM artifacts WHERE run_id = ?", (run_id,))
+        return self.query("SELECT * FROM artifacts WHERE run_id = ? AND kind = ?", (run_id, kind))
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    registry = Registry()
+    print("exp, status, iterations, best_power, runtime [s], results_dir")
+    for run in registry.best_per_spec():
+        print(run['exp'], run['status'], run['iterations'], run['best_power'], run['runtime'], run['results_dir'])
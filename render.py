@@ -0,0 +1,153 @@
+import os
+import re
+import sys
+import csv
+import json
+import glob
+import numpy as np
+import multiprocessing as mp
+from math import ceil, sqrt
+from PIL import Image
+
+
+'''
+Headless (Agg) rendering of optimization results.
+Per-iteration distribution images are rendered in a process pool and only for iterations
+added since the last render (byte offsets kept in render/manifest.json), then tiled into
+overview sheets, a total power figure and an animation of the topology evolution.
+    python render.py results            # one run
+    python render.py sweeps/alpha_adam  # every run folder of a sweep
+'''
+
+HISTORY = {
+    'cond': "cond_smoothed_history.txt",
+    'primal': "primal_history.txt",
+    'grad_CST': "grad_CST_history.txt",
+    'step': "step_history.txt",
+    }
+
+BLOCK_START = re.compile(r'^Iteration', re.MULTILINE)
+
+def parse_new_blocks(path, offset=0):
+    # complete "IterationN ...\n[values]" blocks after byte offset, and the offset after the last one
+    if not os.path.exists(path): return [], offset
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        content = file.read().decode()
+    starts = [match.start() for match in BLOCK_START.finditer(content)]
+    blocks = []
+    end = 0
+    for k, start in enumerate(starts):
+        stop = starts[k+1] if k+1 < len(starts) else len(content)
+        block = content[start:stop]
+        if not block.rstrip().endswith(']'): break # still being written
+        header, values = block.split('\n', 1)
+        iteration = int(header[len('Iteration'):].split(',')[0])
+        values = values.replace('[', ' ').replace(']', ' ').split()
+        blocks.append((iteration, np.array(values, float)))
+        end = stop
+    return blocks, offset + len(content[:end].encode())
+
+def worker_init():
+    import matplotlib
+    matplotlib.use('Agg') # no display on render nodes
+
+def render_distribution(task):
+    kind, iteration, values, shape, path = task
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+    fig, ax = plt.subplots(figsize=(3, 3), dpi=80)
+    im = ax.imshow(values.reshape(shape), origin='upper', norm=colors.CenteredNorm(), cmap='coolwarm')
+    ax.set_title(f"{kind} {iteration}", fontsize=9)
+    ax.axis('off')
+    fig.colorbar(im, ax=ax, fraction=0.046)
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+def render_power(results_dir, out_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    path = os.path.join(results_dir, "total_power.csv")
+    if not os.path.exists(path): return None
+    with open(path, newline='') as csvfile:
+        power = np.array([float(row[0]) for row in csv.reader(csvfile) if row])
+    if len(power) == 0: return None
+    fig, ax = plt.subplots()
+    ax.plot(np.arange(len(power)), power/np.max(power), marker='o')
+    ax.grid()
+    ax.set_title("Total Power")
+    ax.set_xlabel("Iterations")
+    ax.set_ylabel("Relative Power")
+    out = os.path.join(out_dir, "power.png")
+    fig.savefig(out)
+    plt.close(fig)
+    return out
+
+def tile(paths, out):
+    # overview sheet of per-iteration images, like Plotter.plot_distribution's subplot grid
+    images = [Image.open(path) for path in paths]
+    cols = ceil(sqrt(len(images)))
+    rows = ceil(len(images) / cols)
+    w, h = images[0].size
+    sheet = Image.new('RGB', (cols*w, rows*h), 'white')
+    for index, image in enumerate(images):
+        sheet.paste(image, ((index % cols)*w, (index // cols)*h))
+    sheet.save(out)
+    return out
+
+def animate(paths, out, duration=300):
+    frames = [Image.open(path).convert('P', palette=Image.ADAPTIVE) for path in paths]
+    frames[0].save(out, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+    return out
+
+def plan_run(results_dir, shape=None):
+    # tasks for iterations not rendered yet, manifest updated once they are done
+    out_dir = os.path.join(results_dir, "render")
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    manifest = {'offsets': {}, 'images': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file: manifest = json.load(file)
+    tasks = []
+    for kind, name in HISTORY.items():
+        blocks, offset = parse_new_blocks(os.path.join(results_dir, name), manifest['offsets'].get(kind, 0))
+        manifest['offsets'][kind] = offset
+        images = manifest['images'].setdefault(kind, [])
+        for iteration, values in blocks:
+            grid = shape or (int(round(sqrt(len(values)))),)*2
+            path = os.path.join(out_dir, f"{kind}_{iteration:04d}.png")
+            tasks.append((kind, iteration, values, grid, path))
+            images.append(path)
+    return out_dir, manifest, tasks
+
+def finish_run(results_dir, out_dir, manifest, new_images):
+    with open(os.path.join(out_dir, "manifest.json"), "w") as file: json.dump(manifest, file, indent=1)
+    if not new_images: return # nothing new, summaries are up to date
+    render_power(results_dir, out_dir)
+    for kind, images in manifest['images'].items():
+        if images: tile(images, os.path.join(out_dir, f"{kind}_overview.png"))
+    if manifest['images'].get('primal'):
+        animate(manifest['images']['primal'], os.path.join(out_dir, "primal.gif"))
+
+def render(results_dirs, processes=None, shape=None):
+    '''
+    Render every results folder in results_dirs with one shared process pool.
+    shape: (nx, ny) of the design grid, square grids are inferred.
+    '''
+    plans = [(results_dir,) + plan_run(results_dir, shape) for results_dir in results_dirs]
+    tasks = [task for plan in plans for task in plan[3]]
+    print(f"Rendering {len(tasks)} new images for {len(plans)} runs...")
+    with mp.Pool(processes=processes, initializer=worker_init) as pool:
+        for _ in pool.imap_unordered(render_distribution, tasks, chunksize=8): pass
+    for results_dir, out_dir, manifest, run_tasks in plans:
+        finish_run(results_dir, out_dir, manifest, run_tasks)
+    print("Rendering done")
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "results"
+    if os.path.exists(os.path.join(folder, HISTORY['primal'])): folders = [folder]
+    else: folders = sorted(os.path.dirname(path) for path in glob.glob(os.path.join(folder, "*", "results", HISTORY['primal'])))
+    render(folders)
@@ -0,0 +1,143 @@
+import os
+import glob
+import time
+import numpy as np
+import Antenna_Design as ad
+
+
+'''
+Record-and-replay solver backend.
+Recorder wraps a Controller and stores every solve of a run (conductivity in; port signals,
+received power and E field out) as one compressed .npz per solve. ReplayController serves
+those records to Optimizer in place of a Controller, picking the same or nearest recorded
+distribution, so the decision logic of a long run can be replayed and tuned without CST
+(project setup is baked into the recording). Replays of symmetric runs (xz_symmetric_boundary)
+match binarized designs on the solved y>=0 half only, like the recording project saw them.
+    topop = Recorder(ad.Controller("CST_Antennas/topop.cst"), "replay")   # record a run
+    topop = ReplayController("replay")                                     # replay it
+'''
+
+def cond_feature(cond):
+    # compare distributions on the optimizer's [0,1] log scale rather than raw siemens
+    return np.log10(np.asarray(cond, float) + 1) / 7.76
+
+
+class Recorder:
+    _own = ('controller', 'folder', 'count', 'cond', 'dtype')
+
+    def __init__(self, controller, folder="replay", dtype=np.float32):
+        self.controller = controller
+        self.folder = folder
+        self.dtype = dtype # stored field precision, CST ASCII export carries ~float32 digits anyway
+        os.makedirs(folder, exist_ok=True)
+        self.count = len(glob.glob(os.path.join(folder, "*.npz")))
+        self.cond = None
+
+    # everything else (setup calls, time_step, time_end...) goes straight to the controller
+    def __getattr__(self, name):
+        return getattr(self.controller, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own: object.__setattr__(self, name, value)
+        else: setattr(self.controller, name, value)
+
+    def update_distribution(self, cond, pixels=None):
+        self.cond = np.array(cond, float)
+        return self.controller.update_distribution(cond, pixels)
+
+    def plane_wave_excitation(self, excitePath=None):
+        E_Path, powerPath = self.controller.plane_wave_excitation(excitePath)
+        self.save("rx", E_Path, power=np.loadtxt(powerPath, skiprows=3))
+        return E_Path, powerPath
+
+    def feed_excitation(self, feedPath):
+        E_Path = self.controller.feed_excitation(feedPath)
+        self.save("tx", E_Path, feed=np.loadtxt(feedPath, skiprows=3))
+        return E_Path
+
+    def save(self, kind, E_Path, **arrays):
+        if E_Path is None: # export_fields off, a record without fields can't be replayed
+            print(f"{kind} solve without E field not recorded")
+            return
+        signals = {name: np.array(value, float) for name, value in self.controller.last_signals.items()}
+        path = os.path.join(self.folder, f"{self.count:05d}_{kind}.npz")
+        np.savez_compressed(path, kind=kind, cond=self.cond.astype(np.float32),
+                            E=ad.read_E_file(E_Path, dtype=self.dtype),
+                            time_step=self.controller.time_step, time_end=self.controller.time_end,
+                            **arrays, **signals)
+        self.count += 1
+        print(f"Recorded {kind} solve as {path}")
+
+
+class ReplayController(ad.StandInController):
+    def __init__(self, folder="replay", max_distance=np.inf, config=None):
+        self.folder = folder
+        self.max_distance = max_distance # refuse nearest matches further than this (rms on [0,1] scale)
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        self.time_step = self.config.TSTEP
+        self.time_end = self.config.TEND
+        self.d = self.config.D
+        self.cond = None
+        self.last_signals = {}
+        self.tag = "" # file and signal name suffix (multi-incidence controllers)
+        self.incidence = ad.INCIDENCE # recordings carry their own incidence, kept for interface only
+        self.hits = {'exact': 0, 'nearest': 0}
+        self.records = {'rx': [], 'tx': []}
+        self.topologies = {'rx': {}, 'tx': {}} # binarized records by Topology, exact hits skip the scan
+        self.halves = {'rx': {}, 'tx': {}} # same by the solved half of symmetric runs
+        for path in sorted(glob.glob(os.path.join(folder, "*.npz"))):
+            with np.load(path) as record:
+                kind = str(record['kind'])
+                self.records[kind].append((path, cond_feature(record['cond'])))
+                if ad.Topology.is_binary(record['cond']):
+                    self.topologies[kind].setdefault(ad.Topology.from_cond(record['cond']), len(self.records[kind])-1)
+                    half = self.config.solved_half(True, len(record['cond']))
+                    if half is not None: self.halves[kind].setdefault(ad.Topology.from_cond(record['cond'], half=half), len(self.records[kind])-1)
+        print(f"Replay: {len(self.records['rx'])} rx and {len(self.records['tx'])} tx solves loaded from {folder}")
+
+    def lookup(self, kind):
+        if not self.records[kind]: raise RuntimeError(f"Replay: no recorded {kind} solve")
+        half = self.config.solved_half(self.symmetric, len(self.cond))
+        solved = slice(None) if half is None else half # compare on the solved pixels only
+        feature = cond_feature(self.cond)[solved]
+        if ad.Topology.is_binary(self.cond):
+            best = (self.topologies if half is None else self.halves)[kind].get(ad.Topology.from_cond(self.cond, half=half))
+            if best is not None and np.array_equal(self.records[kind][best][1][solved], cond_feature(self.cond.astype(np.float32))[solved]): # stored as float32
+                self.hits['exact'] += 1
+                return np.load(self.records[kind][best][0])
+        distance = [np.sqrt(np.mean((f[solved] - feature)**2)) for _, f in self.records[kind]]
+        best = int(np.argmin(distance))
+        if distance[best] > self.max_distance:
+            raise RuntimeError(f"Replay: nearest {kind} solve is {distance[best]} away")
+        if distance[best] == 0: self.hits['exact'] += 1
+        else:
+            self.hits['nearest'] += 1
+            print(f"Replay: nearest {kind} solve at distance {distance[best]}")
+        return np.load(self.records[kind][best][0])
+
+    # Controller interface used by Optimizer----------------------------------------------------
+    def update_distribution(self, cond, pixels=None):
+        self.cond = np.array(cond, float)
+
+    def plane_wave_excitation(self, excitePath=None):
+        start = time.time()
+        with self.lookup("rx") as record:
+            E_Path = f"txtf\\E_received{self.tag}.npy"
+            np.save(E_Path, record['E'])
+            powerPath = f"txtf\\power{self.tag}.txt"
+            ad.write_signal_file(powerPath, record['power'])
+            self.last_signals = {'Rx_signal': record['Rx_signal']}
+        ad.record_signal('Rx_signal' + self.tag, self.last_signals['Rx_signal'], enabled=self.record_signals)
+        print(f"pw: replayed in {time.time()-start} s")
+        return E_Path, powerPath
+
+    def feed_excitation(self, feedPath):
+        start = time.time()
+        with self.lookup("tx") as record:
+            E_Path = f"txtf\\E_excited{self.tag}.npy"
+            np.save(E_Path, record['E'])
+            self.last_signals = {name: record[name] for name in ('Tx_input_signal', 'Tx_reflected_signal')}
+        for name, signal in self.last_signals.items(): ad.record_signal(name + self.tag, signal, enabled=self.record_signals)
+        print(f"fe: replayed in {time.time()-start} s")
+        return E_Path
+
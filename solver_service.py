@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import socket
+import struct
+import argparse
+import socketserver
+import numpy as np
+import Antenna_Design as ad
+
+
+'''
+Solver service: a Controller (or the replay stand-in) behind a small TCP protocol, so the
+optimizer can run on another host than the CST design environment.
+    solver host:    python solver_service.py --project CST_Antennas/topop.cst --port 5555
+    optimizer host: topop = RemoteController("solver-host", 5555)
+                    optimizer = ad.Optimizer(topop, topop)
+Messages are an 8 byte header length, a JSON header and the raw bytes of the arrays the
+header lists, streamed in CHUNK sized pieces straight into numpy buffers. Excitation files go
+to the solver, fields come back as binary arrays (saved as .npy, read_E_file reads them).
+'''
+
+CHUNK = 1 << 22 # 4 MB
+
+# Controller calls the service accepts
+METHODS = ('update_distribution', 'plane_wave_excitation', 'feed_excitation',
+           'set_base', 'set_domain', 'set_monitor', 'set_time_solver', 'xz_symmetric_boundary',
+           'delete_results', 'delete_signal1', 'save', 'close_project', 'batch_report', 'set_fidelity', 'set_cells',
+           'setattr', 'getattr', 'ping')
+
+def send_message(sock, header, arrays=()):
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    header = dict(header, arrays=[{'dtype': array.dtype.str, 'shape': array.shape} for array in arrays])
+    header = json.dumps(header, default=lambda value: value.tolist()).encode() # numpy scalars
+    sock.sendall(struct.pack("!Q", len(header)) + header)
+    for array in arrays:
+        view = memoryview(array).cast('B')
+        for start in range(0, len(view), CHUNK): sock.sendall(view[start:start+CHUNK])
+
+def receive_exactly(sock, view):
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:], min(CHUNK, len(view)-received))
+        if n == 0: raise ConnectionError("Solver service connection closed")
+        received += n
+
+def receive_message(sock):
+    size = bytearray(8)
+    receive_exactly(sock, memoryview(size))
+    header = bytearray(struct.unpack("!Q", size)[0])
+    receive_exactly(sock, memoryview(header))
+    header = json.loads(header)
+    arrays = []
+    for meta in header.pop('arrays'):
+        array = np.empty(meta['shape'], np.dtype(meta['dtype']))
+        if array.nbytes: receive_exactly(sock, memoryview(array).cast('B'))
+        arrays.append(array)
+    return header, arrays
+
+
+# Service (solver host)-------------------------------------------------------------------------------
+class SolverService:
+    def __init__(self, controller, dtype=np.float64):
+        self.controller = controller
+        self.dtype = dtype # precision of the fields sent back
+        os.makedirs("txtf", exist_ok=True)
+
+    def call(self, method, args, arrays):
+        c = self.controller
+        if method == 'ping': return {'result': 'pong'}, []
+        if method == 'setattr':
+            setattr(c, args['name'], args['value'])
+            return {}, []
+        if method == 'getattr': return {'result': getattr(c, args['name'])}, []
+        if method == 'update_distribution':
+            pixels = arrays[1] if len(arrays) > 1 else None
+            c.update_distribution(arrays[0], pixels)
+            return {}, []
+        if method == 'plane_wave_excitation':
+            excitePath = None
+            if arrays: # excitation signal sent by the optimizer host
+                excitePath = "txtf\\remote_excitation.txt"
+                ad.write_signal_file(excitePath, arrays[0])
+            E_Path, powerPath = c.plane_wave_excitation(excitePath)
+            signals = self.signals()
+            return {'signals': list(signals)}, [ad.read_E_file(E_Path, dtype=self.dtype), np.loadtxt(powerPath, skiprows=3)] + list(signals.values())
+        if method == 'feed_excitation':
+            feedPath = "txtf\\remote_feed.txt"
+            ad.write_signal_file(feedPath, arrays[0])
+            E_Path = c.feed_excitation(feedPath)
+            signals = self.signals()
+            return {'signals': list(signals)}, [ad.read_E_file(E_Path, dtype=self.dtype)] + list(signals.values())
+        result = getattr(c, method)(*args.get('args', []))
+        return {'result': result if isinstance(result, (type(None), bool, int, float, str)) else None}, []
+
+    def signals(self):
+        return {name: np.array(value, float) for name, value in getattr(self.controller, 'last_signals', {}).items()}
+
+    def serve(self, host="0.0.0.0", port=5555):
+        service = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                print(f"Solver service: client {self.client_address} connected")
+                while True:
+                    try: header, arrays = receive_message(self.request)
+                    except ConnectionError: break
+                    method = header['method']
+                    start = time.time()
+                    try:
+                        if method not in METHODS: raise ValueError(f"Unknown method {method}")
+                        reply, out = service.call(method, header.get('args', {}), arrays)
+                        reply['ok'] = True
+                    except Exception as e:
+                        print(f"Solver service: {method} failed: {e}")
+                        reply, out = {'ok': False, 'error': f"{type(e).__name__}: {e}"}, []
+                    reply['seconds'] = time.time() - start
+                    send_message(self.request, reply, out)
+                print(f"Solver service: client {self.client_address} disconnected")
+        # one client at a time, the design environment solves one project anyway
+        class Server(socketserver.TCPServer): allow_reuse_address = True
+        with Server((host, port), Handler) as server:
+            print(f"Solver service listening on {host}:{port}")
+            server.serve_forever()
+
+
+# Client backend (optimizer host)-------------------------------------------------------------------
+class RemoteController:
+    '''
+    Stands in for Controller in Optimizer; every call is forwarded to a SolverService.
+    time_step, time_end, persistent_excitation and incidence are mirrored to the remote controller.
+    '''
+    _remote = ('time_step', 'time_end', 'persistent_excitation', 'incidence')
+
+    def __init__(self, host="localhost", port=5555, config=None, timeout=None):
+        self.config = ad.DEFAULT_CONFIG if config is None else config
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.last_signals = {}
+        self.tag = "" # local file and signal name suffix (multi-incidence controllers)
+        self.symmetric = False # remote project has the xz symmetric boundary (Topology keys of the solved half)
+        self.record_signals = True # False keeps the received signals out of the local signal store
+        self.transfer = {} # {method: [(seconds total, seconds solving, bytes),...]}
+        self.call('ping')
+        print(f"Connected to solver service {host}:{port}")
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self._remote: self.call('setattr', {'name': name, 'value': value})
+
+    def call(self, method, args=None, arrays=()):
+        start = time.time()
+        send_message(self.sock, {'method': method, 'args': args or {}}, arrays)
+        reply, out = receive_message(self.sock)
+        if not reply['ok']: raise RuntimeError(f"Solver service: {reply['error']}")
+        self.transfer.setdefault(method, []).append((time.time()-start, reply['seconds'], sum(a.nbytes for a in out)))
+        return reply, out
+
+    # Controller interface used by Optimizer----------------------------------------------------
+    def update_distribution(self, cond, pixels=None):
+        arrays = [np.asarray(cond, float)]
+        if pixels is not None: arrays.append(np.asarray(pixels, np.int64))
+        self.call('update_distribution', arrays=arrays)
+
+    def plane_wave_excitation(self, excitePath=None):
+        arrays = [] if not excitePath else [np.loadtxt(excitePath, skiprows=3)]
+        reply, out = self.call('plane_wave_excitation', arrays=arrays)
+        E_Path = f"txtf\\E_received{self.tag}.npy"
+        np.save(E_Path, out[0])
+        powerPath = f"txtf\\power{self.tag}.txt"
+        ad.write_signal_file(powerPath, out[1])
+        self.last_signals = dict(zip(reply['signals'], out[2:]))
+        for name, signal in self.last_signals.items(): ad.record_signal(name + self.tag, signal, enabled=self.record_signals)
+        return E_Path, powerPath
+
+    def feed_excitation(self, feedPath):
+        reply, out = self.call('feed_excitation', arrays=[np.loadtxt(feedPath, skiprows=3)])
+        E_Path = f"txtf\\E_excited{self.tag}.npy"
+        np.save(E_Path, out[0])
+        self.last_signals = dict(zip(reply['signals'], out[1:]))
+        for name, signal in self.last_signals.items(): ad.record_signal(name + self.tag, signal, enabled=self.record_signals)
+        return E_Path
+
+    def set_base(self): self.call('set_base')
+    def set_domain(self): self.call('set_domain')
+    def set_monitor(self): self.call('set_monitor')
+    def set_time_solver(self): self.call('set_time_solver')
+    def xz_symmetric_boundary(self):
+        self.call('xz_symmetric_boundary')
+        self.symmetric = True
+    def delete_results(self): self.call('delete_results')
+    def delete_signal1(self): self.call('delete_signal1')
+    def save(self): self.call('save')
+    def set_fidelity(self, name, settings): self.call('set_fidelity', {'args': [name, settings]})
+    def set_cells(self, boxes, cond): self.call('set_cells', {'args': [np.asarray(boxes).tolist(), np.asarray(cond).tolist()]})
+    def close_project(self): self.call('close_project')
+
+    def batch_report(self):
+        for method, calls in self.transfer.items():
+            total, solving, nbytes = np.sum(calls, axis=0)
+            print(f"Remote '{method}': {len(calls)} calls, {solving:.1f} s solving, {total-solving:.1f} s overhead, {nbytes/2**20:.1f} MB received")
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=['cst', 'replay'], default='cst')
+    parser.add_argument("--project", default="CST_Antennas/topop.cst")
+    parser.add_argument("--replay", default="replay")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--float32", action="store_true", help="send fields as float32")
+    args = parser.parse_args()
+    if args.backend == 'replay':
+        import replay
+        controller = replay.ReplayController(args.replay)
+    else:
+        controller = ad.Controller(args.project)
+        controller.delete_results()
+    SolverService(controller, np.float32 if args.float32 else np.float64).serve(args.host, args.port)
@@ -0,0 +1,100 @@
+import os
+import csv
+import numpy as np
+
+
+# Cheap gradient-enhanced surrogate of received power, trained on optimization history
+class Surrogate:
+    '''
+    Kernel weighted first order model: every sample (x_i, y_i, g_i) predicts
+    y_i + s*g_i.(x-x_i) around itself and the predictions are blended with gaussian weights.
+    grad_CST is not in units of received power, so the scale s is fitted (ridge) on sample pairs.
+    '''
+    def __init__(self, ridge=1e-6, min_samples=4, log_path="results\\surrogate.csv"):
+        self.ridge = ridge # regularization of the gradient scale fit
+        self.min_samples = min_samples # abstain (predict None) below this many samples
+        self.log_path = log_path
+        self.X = []
+        self.y = []
+        self.G = []
+        self.scale = 0
+        self.bandwidth = 1
+        self.errors = [] # relative errors of checked predictions
+
+    def add(self, x, y, g):
+        self.X.append(np.array(x, float))
+        self.y.append(float(y))
+        self.G.append(np.array(g, float))
+        self.fit()
+
+    def fit(self):
+        if len(self.y) < 2: return
+        X, y, G = np.array(self.X), np.array(self.y), np.array(self.G)
+        # Taylor prediction of sample i from every other sample j: y_i - y_j ~ s*g_j.(x_i-x_j)
+        dX = X[:, None, :] - X[None, :, :]
+        a = (y[:, None] - y[None, :]).ravel()
+        b = np.einsum('jk,ijk->ij', G, dX).ravel()
+        self.scale = np.dot(a, b) / (np.dot(b, b) + self.ridge*len(b))
+        dist = np.sqrt(np.sum(dX**2, axis=2))
+        dist = dist[np.triu_indices(len(y), 1)]
+        self.bandwidth = np.median(dist) if np.any(dist > 0) else 1
+
+    def predict(self, X):
+        if len(self.y) < self.min_samples: return None
+        X = np.atleast_2d(np.array(X, float))
+        Xs, y, G = np.array(self.X), np.array(self.y), np.array(self.G)
+        dX = X[:, None, :] - Xs[None, :, :] # [candidate, sample, pixel]
+        d2 = np.sum(dX**2, axis=2)
+        weight = np.exp(-(d2 - d2.min(axis=1, keepdims=True)) / (2*self.bandwidth**2))
+        weight = weight / np.sum(weight, axis=1, keepdims=True)
+        local = y[None, :] + self.scale*np.einsum('jk,ijk->ij', G, dX)
+        return np.sum(weight*local, axis=1)
+
+    def screen(self, candidates, top_k=1):
+        # indices of the top_k most promising candidates, all of them if the model abstains
+        prediction = self.predict(candidates)
+        if prediction is None: return list(range(len(candidates))), None
+        order = np.argsort(-prediction)[:top_k]
+        return list(order), prediction[order]
+
+    def check(self, predicted, actual, iteration=None):
+        # track accuracy of a prediction once the solver result is known
+        if predicted is None: return
+        error = (predicted - actual) / (abs(actual) + 1e-30)
+        self.errors.append(error)
+        print(f"surrogate predicted={predicted}, actual={actual}, relative error={error}")
+        with open(self.log_path, 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([iteration, predicted, actual, error])
+
+    def accuracy(self):
+        if not self.errors: return None
+        return np.sqrt(np.mean(np.array(self.errors)**2)) # rms relative error
+
+
+def parse_history(file_path):
+    # same format as Plotter.parse_iteration_blocks, without the plotting dependencies
+    with open(file_path, 'r') as file:
+        content = file.read().strip()
+    result = []
+    for block in content.split('Iteration')[1:]:
+        block_content = block.strip().split('\n', 1)[1]
+        block_content = block_content.replace('\n', ' ').replace('[', '').replace(']', '')
+        result.append([float(num) for num in block_content.split()])
+    return result
+
+def surrogate_from_history(folder="results", **kwargs):
+    # train on (primal, received power, gradient) samples recorded by Optimizer.gradient_ascent
+    surrogate = Surrogate(log_path=os.path.join(folder, "surrogate.csv"), **kwargs)
+    primal = parse_history(os.path.join(folder, "primal_history.txt"))
+    grad = parse_history(os.path.join(folder, "grad_CST_history.txt"))
+    with open(os.path.join(folder, "total_power.csv"), newline='') as csvfile:
+        power = [float(row[0]) for row in csv.reader(csvfile) if row]
+    n = min(len(primal), len(grad), len(power))
+    for index in range(n):
+        surrogate.X.append(np.array(primal[index]))
+        surrogate.y.append(power[index])
+        surrogate.G.append(np.array(grad[index]))
+    surrogate.fit()
+    print(f"Surrogate trained on {n} samples")
+    return surrogate
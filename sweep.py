@@ -0,0 +1,152 @@
+import os
+import csv
+import time
+import itertools
+import multiprocessing as mp
+import numpy as np
+
+
+'''
+Hyperparameter sweep runner.
+Every configuration runs in its own folder (own results/, txtf/ and project copy) in its own
+process, so experiments never share or wipe each other's files. Runs are scheduled over
+`slots` worker processes (one per CST licence / design environment, or as many as the
+machine allows for replay backends) and summarized into one table.
+'''
+
+# Defaults mirror main.py
+DEFAULT_CONFIG = {
+    'exp': None, # run name, generated if None
+    'design': {}, # Antenna_Design.DesignConfig overrides, e.g. {'D': 2}
+    'AMP': [0.5, 0.5], 'FREQ': [1.5, 2.4], 'BW': [0.13, 0.07],
+    'alpha': 1, 'linear_map': False, 'filter': False, 'Adam': True,
+    'active_set': False, 'threshold': 0.95,
+    'memory_budget': None, # GB per run, see Antenna_Design.plan_memory
+    'max_iter': 36, 'symmetric': True,
+    'initial': 'square', 'initial_scale': 0.5, # generate_shape name or path of a saved primal (.npy, see multistart.py)
+    'backend': 'cst', # 'cst', 'replay', 'queue' (solves go to jobqueue workers) or 'fdtd' (fdtd.py stand-in)
+    'project': "CST_Antennas/topop.cst", # copied into the run folder for 'cst'
+    'template': False, # 'cst': copy a prepared base project (Antenna_Design.TemplateCache) instead
+    'template_folder': "CST_Antennas/templates",
+    'replay': "replay", # recorded archive for 'replay'
+    'queue': "queue", # shared queue folder for 'queue'
+    'registry': None, # path of a registry.Registry database to record the runs in
+    }
+
+def grid(**options):
+    # grid(alpha=[0.5, 1], Adam=[True, False]) -> list of 4 configurations
+    keys = list(options)
+    return [dict(zip(keys, values)) for values in itertools.product(*options.values())]
+
+def prepare_run(config, run_dir):
+    os.makedirs(os.path.join(run_dir, "results"), exist_ok=True)
+    os.makedirs(os.path.join(run_dir, "txtf"), exist_ok=True)
+    if config['backend'] == 'cst' and not config['template']:
+        import Antenna_Design as ad
+        ad.copy_project(config['project'], os.path.join(run_dir, config['project']))
+
+def run_experiment(args):
+    config, run_dir = args
+    import Antenna_Design as ad # import inside the worker, after the fork/spawn
+    start = time.time()
+    os.chdir(run_dir) # results/ and txtf/ paths are relative to cwd
+    status = "done"
+    try:
+        excitation_generator = ad.Excitation_Generator()
+        excitation_generator.amplitudes = config['AMP']
+        excitation_generator.frequencies = config['FREQ']
+        excitation_generator.ratio_bw = config['BW']
+        excitation_generator.generate()
+        design = ad.DesignConfig(**config['design'])
+        if config['backend'] == 'replay':
+            import replay
+            controller = replay.ReplayController(config['replay'], config=design)
+        elif config['backend'] == 'fdtd':
+            import fdtd
+            controller = fdtd.FDTDController(design)
+        elif config['backend'] == 'queue':
+            import jobqueue
+            controller = jobqueue.QueueController(config['queue'], design, symmetric=config['symmetric'])
+        elif config['template']:
+            templates = ad.TemplateCache(config['template_folder'], design)
+            controller = templates.create(config['project'], excitation_generator.time_step,
+                                          excitation_generator.time_end, config['symmetric'])
+        else:
+            controller = ad.Controller(config['project'], design)
+            controller.delete_results()
+            controller.set_time_solver()
+        # template projects (and queue workers) already carry monitor and symmetric boundary
+        prepared = (config['backend'] == 'cst' and config['template']) or config['backend'] == 'queue'
+        optimizer = ad.Optimizer(controller, controller, set_environment=False)
+        optimizer.specification(excitation_generator.spec_dic, set_monitor=not prepared)
+        optimizer.alpha = config['alpha']
+        optimizer.threshold = config['threshold']
+        optimizer.memory_budget = config['memory_budget']
+        if config['initial'].endswith('.npy'): initial = np.load(config['initial'])
+        else: initial = ad.generate_shape(config['initial'], design)
+        optimizer.primal_init = (initial*config['initial_scale']).ravel()
+        if config['registry']:
+            import registry
+            optimizer.registry = registry.Registry(config['registry'])
+            optimizer.exp = config['exp']
+        optimizer.gradient_ascent(max_iter=config['max_iter'], linear_map=config['linear_map'],
+                                  filter=config['filter'], Adam=config['Adam'],
+                                  symmetric=config['symmetric'] and not prepared, active_set=config['active_set'])
+        if config['backend'] == 'cst': controller.close_project() # other runs may share the design environment
+    except Exception as e:
+        print(f"{run_dir} failed: {e}")
+        status = f"failed: {e}"
+    runtime = time.time() - start
+    power = []
+    if os.path.exists("results/total_power.csv"):
+        with open("results/total_power.csv", newline='') as csvfile:
+            power = [float(row[0]) for row in csv.reader(csvfile) if row]
+    return {'exp': config['exp'], 'status': status, 'iterations': len(power),
+            'final_power': power[-1] if power else np.nan,
+            'best_power': max(power) if power else np.nan,
+            'runtime': runtime, 'folder': run_dir}
+
+def run_sweep(configs, name="sweep", slots=1, root="sweeps"):
+    '''
+    configs: list of dicts overriding DEFAULT_CONFIG (see grid)
+    slots: number of experiments running side by side
+    Returns summary rows, also written to {root}/{name}/summary.csv
+    '''
+    sweep_dir = os.path.abspath(os.path.join(root, name))
+    jobs = []
+    for index, overrides in enumerate(configs):
+        config = dict(DEFAULT_CONFIG, **overrides)
+        if config['exp'] is None: config['exp'] = f"run{index:03d}"
+        if config['backend'] == 'replay': config['replay'] = os.path.abspath(config['replay'])
+        if config['backend'] == 'queue': config['queue'] = os.path.abspath(config['queue'])
+        config['template_folder'] = os.path.abspath(config['template_folder'])
+        if config['registry']: config['registry'] = os.path.abspath(config['registry'])
+        if config['initial'].endswith('.npy'): config['initial'] = os.path.abspath(config['initial'])
+        run_dir = os.path.join(sweep_dir, config['exp'])
+        prepare_run(config, run_dir)
+        jobs.append((config, run_dir))
+    print(f"Sweep {name}: {len(jobs)} runs on {slots} slots")
+    summary = []
+    # maxtasksperchild=1: every run gets a fresh process (own cwd, own CST connection)
+    with mp.Pool(processes=slots, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(run_experiment, jobs):
+            print(f"{result['exp']}: {result['status']}, {result['iterations']} iterations, "
+                  f"final power {result['final_power']}, {result['runtime']:.0f} s")
+            summary.append(result)
+    # Summary table, parameters first
+    keys = sorted({key for config, _ in jobs for key in config if key != 'exp'})
+    params = {config['exp']: config for config, _ in jobs}
+    with open(os.path.join(sweep_dir, "summary.csv"), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['exp'] + keys + ['status', 'iterations', 'final_power', 'best_power', 'runtime', 'folder'])
+        for result in sorted(summary, key=lambda r: r['exp']):
+            config = params[result['exp']]
+            writer.writerow([result['exp']] + [config[key] for key in keys] +
+                            [result[key] for key in ('status', 'iterations', 'final_power', 'best_power', 'runtime', 'folder')])
+    print(f"Summary written to {os.path.join(sweep_dir, 'summary.csv')}")
+    return summary
+
+
+if __name__ == "__main__":
+    configs = grid(alpha=[0.5, 1, 2], Adam=[True, False], backend=['replay'])
+    run_sweep(configs, name="alpha_adam", slots=os.cpu_count())
@@ -1,4 +1,7 @@
+import sys
 import numpy as np
+import matplotlib
+if "--headless" in sys.argv: matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import csv
 
@@ -22,4 +25,5 @@ if __name__ == '__main__':
     plt.title("Total Power")
     plt.xlabel("Iterations")
     plt.ylabel("Relative Power")
-    plt.show()
\ No newline at end of file
+    if "--headless" in sys.argv: plt.savefig("results/total_power.png")
+    else: plt.show()
\ No newline at end of file
@@ -1,52 +1,148 @@
+import os
+import csv
+import argparse
+import itertools
+import multiprocessing as mp
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
 import Antenna_Design as ad
+from render import parse_new_blocks
 
 
-if __name__ == "__main__":
-    # Read and round primal
-    iter = input("iteration: ")
-    threshold = float(input("threshold: "))
-    iter = int(iter)
-    filePath = f"results/primal_history.txt"
-    with open(filePath, 'r') as file:
-        record = False
-        string = ''
-        for line in file:
-            if record: 
-                # print(line)
-                line = line.strip()
-                if line == f'Iteration{iter+1}': break
-                line = line.strip('[')
-                line = line.strip(']')
-                string = string + line + ' '
-            line=line.strip()
-            if line == f'Iteration{iter}': record = True
-    string = np.array(string.split(), float)
-    # print("Read:\n", string)
-    # string = np.rint(string) # ceil, floor, fix
-    for index, val in enumerate(string):
-        if val < threshold: string[index] = 0
-        else: string[index] = 1
-    # print("Rounded:\n",string)
-    # string = np.ones(49)# test
-    cond = string*5.8e7
-
-    # Plot test case
-    im = plt.imshow(cond.reshape(ad.NX, ad.NY),origin='upper',norm=colors.CenteredNorm(),cmap='coolwarm')
-    plt.colorbar(im)
-    plt.show()
-
-    # Set verification
-    flag = input("Continue (y/n)? ")
-    if flag == 'y':
-        transmitter = ad.Controller("CST_Antennas/topop.cst")
-        transmitter.delete_results()
-        try: transmitter.delete_signal1()
+'''
+Batch verification of binarized designs.
+Every (iteration, threshold) pair of primal_history is binarized, identical topologies are
+evaluated once, spread over `slots` solver instances (own project copy each) or the replay
+stand-in backend, and S11 and received power are collected into verify/verification.csv.
+With the project's xz symmetric boundary (symmetric=True) only the solved y>=0 half tells
+topologies apart, designs matching there are one solve.
+    python verification.py --iterations 30 35 --thresholds 0.3 0.5 0.7 --slots 2
+'''
+
+COND = 5.8e7 # copper
+
+def read_primals(path="results/primal_history.txt"):
+    blocks, _ = parse_new_blocks(path)
+    return dict(blocks) # {iteration: primal}
+
+def binarize(primal, threshold):
+    return (primal >= threshold).astype(np.uint8)
+
+def topology_key(binary, symmetric=True):
+    return ad.Topology.from_binary(binary, ad.DEFAULT_CONFIG.solved_half(symmetric, binary.size)).key
+
+def plan(pairs, primals, symmetric=True):
+    # {key: binary} of unique topologies and the key of every pair
+    topologies, keys = {}, {}
+    for iteration, threshold in pairs:
+        if iteration not in primals:
+            print(f"Iteration{iteration} not in history, skipped")
+            continue
+        binary = binarize(primals[iteration], threshold)
+        key = topology_key(binary, symmetric)
+        topologies.setdefault(key, binary)
+        keys[(iteration, threshold)] = key
+    print(f"{len(keys)} pairs -> {len(topologies)} unique topologies")
+    return topologies, keys
+
+def use_solver(controller, solver):
+    # switch without adding to history, the project keeps its time domain setup
+    controller.excute_vba(['Sub Main', f'ChangeSolverType "{solver}"', 'End Sub'])
+
+def measure_s11(controller):
+    controller.set_port(controller.port[0], controller.port[1])
+    controller.set_frequency_solver()
+    controller.start_simulate()
+    s11 = np.array(controller.read('1D Results\\S-Parameters\\S1,1')) # [[freq, s11, 50+j],...]
+    controller.delete_results()
+    controller.delete_port()
+    use_solver(controller, "HF Time Domain")
+    return np.real(s11[:, 0]), 20*np.log10(np.abs(s11[:, 1]))
+
+def evaluate_slot(args):
+    slot_dir, jobs, options = args
+    os.chdir(slot_dir) # txtf/ and results/ are relative to cwd
+    generator = ad.Excitation_Generator(options['AMP'], options['FREQ'], options['BW'])
+    generator.generate()
+    if options['backend'] == 'replay':
+        import replay
+        controller = replay.ReplayController(options['replay'])
+    else:
+        controller = ad.Controller(os.path.join(slot_dir, os.path.basename(options['project'])))
+        controller.delete_results()
+        try: controller.delete_signal1()
         except: pass
-        transmitter.update_distribution(cond)
-        transmitter.set_port(transmitter.port[0], transmitter.port[1])
-        transmitter.set_frequency_solver()
-        transmitter.start_simulate()
-    else: pass
\ No newline at end of file
+    controller.time_step = generator.time_step
+    controller.time_end = generator.time_end
+    controller.symmetric = options['symmetric'] # boundary already in the copied project
+    rows = []
+    for key, binary in jobs:
+        print(f"Verifying topology {key} ({int(binary.sum())} pixels on)")
+        row = {'topology': key, 'pixels_on': int(binary.sum()), 'received_power': np.nan,
+               's11_min_dB': np.nan, 's11_min_freq': np.nan}
+        try:
+            controller.update_distribution(binary*COND)
+            _, powerPath = controller.plane_wave_excitation(generator.excitePath)
+            row['received_power'] = ad.received_power(powerPath, generator.power)
+            if options['backend'] == 'cst':
+                freq, s11 = measure_s11(controller)
+                np.savetxt(os.path.join(options['out'], f"s11_{key}.csv"), np.stack([freq, s11], axis=1),
+                           delimiter=',', header="freq [GHz], S11 [dB]")
+                row['s11_min_dB'] = np.min(s11)
+                row['s11_min_freq'] = freq[np.argmin(s11)]
+        except Exception as e: print(f"Topology {key} failed: {e}")
+        rows.append(row)
+    if options['backend'] == 'cst': controller.close_project()
+    return rows
+
+def verify(pairs, slots=1, backend='cst', project="CST_Antennas/topop.cst", replay="replay",
+           history="results/primal_history.txt", out="verify", symmetric=True,
+           AMP=[0.5, 0.5], FREQ=[1.5, 2.4], BW=[0.13, 0.07]):
+    out = os.path.abspath(out)
+    os.makedirs(out, exist_ok=True)
+    topologies, keys = plan(pairs, read_primals(history), symmetric)
+    # topologies verified by an earlier batch are not solved again
+    done = {}
+    table = {} # {(iteration, threshold): row} of earlier batches, kept in the rewritten table
+    table_path = os.path.join(out, "verification.csv")
+    if os.path.exists(table_path):
+        with open(table_path, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                done[row['topology']] = row
+                table[(int(row['iteration']), float(row['threshold']))] = row
+    todo = [(key, binary) for key, binary in topologies.items() if key not in done]
+    options = {'backend': backend, 'project': os.path.abspath(project), 'replay': os.path.abspath(replay),
+               'out': out, 'AMP': AMP, 'FREQ': FREQ, 'BW': BW, 'symmetric': symmetric}
+    jobs = []
+    for slot in range(min(slots, len(todo))):
+        slot_dir = os.path.join(out, f"slot{slot}")
+        os.makedirs(os.path.join(slot_dir, "txtf"), exist_ok=True)
+        os.makedirs(os.path.join(slot_dir, "results"), exist_ok=True)
+        if backend == 'cst': ad.copy_project(project, os.path.join(slot_dir, os.path.basename(project)))
+        jobs.append((slot_dir, todo[slot::slots], options))
+    print(f"Verifying {len(todo)} topologies on {len(jobs)} slots ({len(topologies)-len(todo)} already verified)")
+    with mp.Pool(processes=max(len(jobs), 1), maxtasksperchild=1) as pool:
+        for rows in pool.imap_unordered(evaluate_slot, jobs):
+            for row in rows: done[row['topology']] = row
+    # one row per (iteration, threshold) pair, this batch's pairs replace earlier rows
+    fields = ['iteration', 'threshold', 'topology', 'pixels_on', 'received_power', 's11_min_dB', 's11_min_freq']
+    for (iteration, threshold), key in keys.items():
+        table[(iteration, threshold)] = dict(done[key], iteration=iteration, threshold=threshold)
+    with open(table_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fields)
+        for pair in sorted(table): writer.writerow([table[pair][field] for field in fields])
+    print(f"Verification table written to {table_path}")
+    return table_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, nargs="+")
+    parser.add_argument("--thresholds", type=float, nargs="+")
+    parser.add_argument("--slots", type=int, default=1)
+    parser.add_argument("--backend", choices=['cst', 'replay'], default='cst')
+    parser.add_argument("--asymmetric", action="store_true", help="project without the xz symmetric boundary")
+    args = parser.parse_args()
+    iterations = args.iterations or [int(i) for i in input("iterations: ").split()]
+    thresholds = args.thresholds or [float(t) for t in input("thresholds: ").split()]
+    verify(list(itertools.product(iterations, thresholds)), slots=args.slots, backend=args.backend, symmetric=not args.asymmetric)